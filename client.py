@@ -1,15 +1,27 @@
+import collections
 import sys
+import select
 import socket
+import threading
+import time
 import pygame
 import math
 from common.game_objects import Player, Enemy, Bullet, Wall, LootBox, Mine
-from common.network import NetworkProtocol, GameState
+from common.network import NetworkProtocol, GameState, FrameReader
+from common.codec import SnapshotDecoder, decode_message, pack_input, PLAYER_INPUT
+from common.maps import MapLayout, MapCache
+from common.udp import DatagramChannel, InputHistory, KIND_HELLO, KIND_SNAPSHOT, MAX_DATAGRAM
+from common.codec import ProtocolError
+from common.stats import FrameTimes
+from common.interpolation import SnapshotBuffer, TICK_RATE
+from common.movement import move_player, INPUT_RATE, MAX_INPUTS_PER_TICK
+from common.spatial import WallIndex
 
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
 
 class GameClient:
-    def __init__(self, server_ip, port=5555):
+    def __init__(self, server_ip, port=5555, use_udp=False, show_stats=False, render_delay=0.1):
         pygame.init()
         self.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
         pygame.display.set_caption("Boxhead Multiplayer")
@@ -19,9 +31,37 @@ class GameClient:
         # Connect to server
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((server_ip, port))
-        
+        self.reader = FrameReader(self.socket)
+        self.send_lock = threading.Lock()  # Inputs and snapshot acks come from different threads
+        self.server_ip = server_ip
+
+        # Optional datagram transport for snapshots and inputs, set up once
+        # the server sends its udp_info over TCP
+        self.use_udp = use_udp
+        self.udp_socket = None
+        self.udp_token = None
+        self.udp_confirmed = False
+        self.udp_channel = DatagramChannel()
+        self.input_history = InputHistory()
+        self.input_seq = 0
+        self.last_input_time = time.monotonic()
+
+        # Client-side prediction: inputs the server has not applied yet, each
+        # with the position we predicted after it
+        self.pending_inputs = collections.deque()
+        self.predicted = None  # (x, y) of the local player, None until the first snapshot
+        self.predicted_angle = 0
+        self.prediction_base = None  # Own player in the newest snapshot
+        self.prediction_walls = WallIndex()  # Index of the wall list below
+        self.prediction_wall_list = None
+        self.corrections = 0
+        self.max_correction = 0
+
         # Game state
-        self.game_state = GameState()
+        self.game_state = GameState()  # Kept up to date in place by apply_snapshot
+        self.snapshot_decoder = SnapshotDecoder()
+        self.map_cache = MapCache()
+        self.map_layout = None
         self.player_id = None
         self.keys = {
             'w': False,
@@ -33,12 +73,23 @@ class GameClient:
         self.mouse_aim_enabled = True
         self.keyboard_target_pos = [SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2]
         self._keyboard_target_speed = 10
+        self.show_stats = show_stats
+        self.frame_times = FrameTimes()
+
+        # The network thread decodes snapshots and leaves them here; the
+        # render loop takes whatever has arrived and never waits on a socket.
+        # deque append/popleft are atomic, no lock needed.
+        self.snapshots = collections.deque(maxlen=8)
+        self.interpolation = SnapshotBuffer(render_delay)
+        self.drawn = {key: [] for key in SnapshotBuffer.DRAWN}  # Entities as of the render time, see update
+        self.network_thread = threading.Thread(target=self.receive_loop, daemon=True)
+        self.network_thread.start()
 
     def handle_input(self):
         for event in pygame.event.get():
             if getattr(self.game_state, 'game_over', False):
                 if event.type == pygame.KEYDOWN and event.key == pygame.K_r:
-                    NetworkProtocol.send_message(self.socket, {'type': 'restart_game', 'data': {}})
+                    self.send_message({'type': 'restart_game', 'data': {}})
                     return
             if self.player_id is not None and self.player_id in self.game_state.players:
                 player = self.game_state.players[self.player_id]
@@ -61,7 +112,7 @@ class GameClient:
                     if pygame.K_1 <= event.key <= pygame.K_9:
                         idx = event.key - pygame.K_1
                         if idx < len(player.weapons):
-                            NetworkProtocol.send_message(self.socket, {
+                            self.send_message({
                                 'type': 'switch_weapon',
                                 'data': {'selected_weapon_index': idx}
                             })
@@ -140,9 +191,20 @@ class GameClient:
                 angle = math.degrees(math.atan2(world_mouse_y - player.y, world_mouse_x - player.x))
                 shooting = pygame.mouse.get_pressed()[0] or pygame.key.get_pressed()[pygame.K_SPACE]
 
-        NetworkProtocol.send_message(self.socket, {
-            'type': 'player_input',
-            'data': {
+        # One input per simulation step, sent at the server's tick rate no
+        # matter how fast we render, so both ends move the player equally far
+        now = time.monotonic()
+        steps = int((now - self.last_input_time) * INPUT_RATE)
+        if steps > MAX_INPUTS_PER_TICK:
+            steps = MAX_INPUTS_PER_TICK
+            self.last_input_time = now
+        else:
+            self.last_input_time += steps / INPUT_RATE
+        self.predicted_angle = angle
+        for _ in range(steps):
+            self.input_seq += 1
+            input_data = {
+                'seq': self.input_seq,
                 'dx': dx,
                 'dy': dy,
                 'angle': angle,
@@ -150,17 +212,149 @@ class GameClient:
                 'mouse_x': world_mouse_x,
                 'mouse_y': world_mouse_y
             }
-        })
+            # Predict from the values as the server will unpack them
+            self.predict(PLAYER_INPUT.unpack_from(pack_input(input_data), 0))
+            if self.udp_socket is not None:
+                # Every datagram repeats the last few inputs and acks the newest snapshot
+                self.input_history.add(input_data)
+                self.send_datagram(self.input_history.packet(self.snapshot_decoder.ack_tick))
+                if not self.udp_confirmed:
+                    self.send_datagram(DatagramChannel.pack(KIND_HELLO, 0, self.udp_token))
+            else:
+                self.send_message({'type': 'player_input', 'data': input_data})
+
+    def predict(self, input_data):
+        base = self.prediction_base
+        if self.predicted is not None and not base.dead:
+            self.predicted = move_player(self.predicted[0], self.predicted[1], input_data['dx'], input_data['dy'],
+                                         base.speed, base.size, self.prediction_walls)
+        self.pending_inputs.append((input_data, self.predicted))
+
+    def reconcile(self, state):
+        """Rebase the prediction on an authoritative state and replay what the server has not seen."""
+        player = state.players.get(self.player_id)
+        if player is None:
+            return
+        pending = self.pending_inputs
+        while pending and pending[0][0]['seq'] <= player.input_seq:
+            input_data, predicted = pending.popleft()
+            if input_data['seq'] == player.input_seq and predicted is not None:
+                error = math.hypot(predicted[0] - player.x, predicted[1] - player.y)
+                if error > 0:
+                    self.corrections += 1
+                    self.max_correction = max(self.max_correction, error)
+        self.prediction_base = player
+        if state.walls is not self.prediction_wall_list:
+            # apply_snapshot only replaces the wall list when a wall was built, damaged or destroyed
+            self.prediction_walls = WallIndex(state.walls)
+            self.prediction_wall_list = state.walls
+        x, y = player.x, player.y
+        replayed = []
+        for input_data, _ in pending:
+            if not player.dead:
+                x, y = move_player(x, y, input_data['dx'], input_data['dy'], player.speed, player.size, self.prediction_walls)
+            replayed.append((input_data, (x, y)))
+        self.pending_inputs = collections.deque(replayed)
+        self.predicted = (x, y)
+
+    def send_message(self, message):
+        with self.send_lock:
+            NetworkProtocol.send_message(self.socket, message)
+
+    def send_datagram(self, data):
+        try:
+            self.udp_socket.send(data)
+        except OSError:
+            pass  # Lost like any other datagram
+
+    def receive_loop(self):
+        # Runs on the network thread
+        try:
+            while self.running:
+                sockets = [self.socket] if self.udp_socket is None else [self.socket, self.udp_socket]
+                readable, _, _ = select.select(sockets, [], [])
+                if self.udp_socket is not None and self.udp_socket in readable:
+                    self.receive_datagrams()
+                if self.socket in readable:
+                    if not self.reader.fill():
+                        break
+                    # One recv can bring in several frames; handle them all before the
+                    # next fill reuses the buffer
+                    for frame in self.reader.frames():
+                        self.handle_message(decode_message(frame))
+        except (OSError, ProtocolError) as e:
+            print(f"Network error: {e}")
+        if self.running:
+            print("Disconnected from server")
+            self.running = False
 
     def update(self):
-        message = NetworkProtocol.receive_message(self.socket)
-        if message:
-            if message['type'] == 'game_state':
-                self.game_state = GameState.from_dict(message['data'])
-                if self.player_id is None and self.game_state.players:
-                    self.player_id = max(self.game_state.players.keys())
-            elif message['type'] == 'switch_weapon_ack':
-                pass
+        # Non-blocking: buffer whatever arrived and draw the interpolated view
+        while self.snapshots:
+            snapshot, received_at = self.snapshots.popleft()
+            # One live GameState, updated in place; only changed records are decoded
+            self.game_state.apply_snapshot(snapshot, self.map_layout)
+            self.reconcile(self.game_state)
+            self.interpolation.add(self.game_state, received_at)
+        drawn = self.interpolation.sample(time.monotonic())
+        if drawn is not None:
+            self.drawn = drawn
+        # Everyone else is drawn in the past, our own player where we predict it
+        player = self.game_state.players.get(self.player_id)
+        if player is not None and self.predicted is not None and not player.dead:
+            player.x, player.y = self.predicted
+            player.angle = self.predicted_angle
+
+    def receive_datagrams(self):
+        while True:
+            try:
+                data = self.udp_socket.recv(MAX_DATAGRAM)
+            except BlockingIOError:
+                return
+            except OSError:
+                return
+            try:
+                kind, seq, payload = DatagramChannel.unpack(data)
+            except ProtocolError:
+                continue
+            # Snapshot sequence numbers are their ticks: only ever move forward
+            if kind == KIND_SNAPSHOT and self.udp_channel.accept(seq):
+                self.udp_confirmed = True
+                self.apply_snapshot(payload)
+
+    def apply_snapshot(self, payload):
+        snapshot = self.snapshot_decoder.decode(payload)
+        if self.udp_socket is None:
+            self.send_message({
+                'type': 'snapshot_ack',
+                'data': {'tick': self.snapshot_decoder.ack_tick}
+            })
+        if snapshot is None:
+            return
+        self.snapshots.append((snapshot, time.monotonic()))
+
+    def handle_message(self, message):
+        if message['type'] == 'game_state':
+            self.apply_snapshot(message['data'])
+        elif message['type'] == 'welcome':
+            self.player_id = message['data']['player_id']
+            self.interpolation.tick_rate = message['data'].get('tick_rate', TICK_RATE)
+        elif message['type'] == 'udp_info':
+            if self.use_udp:
+                self.udp_token = bytes.fromhex(message['data']['token'])
+                self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.udp_socket.connect((self.server_ip, message['data']['port']))
+                self.udp_socket.setblocking(False)
+                self.send_datagram(DatagramChannel.pack(KIND_HELLO, 0, self.udp_token))
+        elif message['type'] == 'map_info':
+            self.map_layout = self.map_cache.load(message['data']['hash'])
+            if self.map_layout is None:
+                self.send_message({'type': 'map_request', 'data': {}})
+        elif message['type'] == 'map':
+            self.map_layout = MapLayout.decode(message['data'])
+            self.map_cache.store(self.map_layout)
+        elif message['type'] == 'switch_weapon_ack':
+            pass
 
     def get_camera_offset(self, player):
         cx = player.x - SCREEN_WIDTH // 2
@@ -177,9 +371,8 @@ class GameClient:
             camera_offset = self.get_camera_offset(player)
 
         # Draw pickups
-        if hasattr(self.game_state, 'pickups'):
-            for pickup in self.game_state.pickups:
-                pickup.draw(self.screen, camera_offset)
+        for pickup in self.drawn['pickups']:
+            pickup.draw(self.screen, camera_offset)
 
         # Draw walls
         if hasattr(self.game_state, 'walls'):
@@ -187,21 +380,19 @@ class GameClient:
                 wall.draw(self.screen, camera_offset)
 
         # Draw lootboxes
-        if hasattr(self.game_state, 'lootboxes'):
-            for lootbox in self.game_state.lootboxes:
-                lootbox.draw(self.screen, camera_offset)
+        for lootbox in self.drawn['lootboxes']:
+            lootbox.draw(self.screen, camera_offset)
 
         # Draw mines
-        if hasattr(self.game_state, 'mines'):
-            for mine in self.game_state.mines:
-                mine.draw(self.screen, camera_offset)
+        for mine in self.drawn['mines']:
+            mine.draw(self.screen, camera_offset)
 
         # Draw enemies
-        for enemy in self.game_state.enemies:
+        for enemy in self.drawn['enemies']:
             enemy.draw(self.screen, camera_offset)
 
         # Draw bullets
-        for bullet in self.game_state.bullets:
+        for bullet in self.drawn['bullets']:
             bullet.draw(self.screen, camera_offset)
 
         # Draw players
@@ -310,6 +501,7 @@ class GameClient:
             self.screen.blit(ammo_text, (10, 60))
 
         # Death message
+        player = self.game_state.players.get(self.player_id)
         if getattr(player, 'dead', False):
             font_big = pygame.font.SysFont(None, 48)
             text = font_big.render(f"UMARŁEŚ! Respawn za {int(max(0, player.respawn_timer))}s", True, (255,0,0))
@@ -328,15 +520,21 @@ class GameClient:
             self.handle_input()
             self.update()
             self.draw()
-            self.clock.tick(60)
+            self.frame_times.add(self.clock.tick(60))
 
+        if self.show_stats:
+            print(f"Frame times: {self.frame_times.summary()}")
+            print(f"Prediction: {self.corrections} corrections, largest {self.max_correction:.2f}px")
         self.socket.close()
         pygame.quit()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python client.py <server_ip>")
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) != 1:
+        print("Usage: python client.py <server_ip> [--udp] [--stats] [--delay=<ms>]")
         sys.exit(1)
     
-    client = GameClient(sys.argv[1])
+    delay = [arg.split('=', 1)[1] for arg in sys.argv[1:] if arg.startswith('--delay=')]
+    client = GameClient(args[0], use_udp='--udp' in sys.argv, show_stats='--stats' in sys.argv,
+                        render_delay=int(delay[0]) / 1000 if delay else 0.1)
     client.run() 
\ No newline at end of file
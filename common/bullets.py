@@ -0,0 +1,195 @@
+import collections
+import math
+import numpy as np
+from common.registry import IdAllocator
+from common.spatial import squared_radius
+
+# One row per field, one column per bullet. Everything fits a float64
+# exactly (ids are 32-bit), so a bullet is a column of a single array.
+FIELDS = ('entity_id', 'x', 'y', 'vx', 'vy', 'origin_x', 'origin_y', 'angle', 'speed',
+          'damage', 'player_id', 'r', 'g', 'b', 'lifetime', 'age')
+(ID, X, Y, VX, VY, ORIGIN_X, ORIGIN_Y, ANGLE, SPEED,
+ DAMAGE, OWNER, R, G, B, LIFETIME, AGE) = range(len(FIELDS))
+
+# Fewer bullet and circle pairs than this are cheaper to test all at once
+DENSE_MAX = 20000
+
+# What the snapshot encoder and the hit tests get to read for one bullet
+BulletState = collections.namedtuple('BulletState', (
+    'entity_id', 'x', 'y', 'angle', 'origin_x', 'origin_y', 'speed', 'age', 'damage', 'player_id', 'color'))
+
+
+def _cell_key(col, row):
+    # Exact in a float64 for any cell a bullet or an enemy can be in
+    return col * 4294967296.0 + row
+
+
+def _state(row):
+    return BulletState(int(row[ID]), row[X], row[Y], row[ANGLE], row[ORIGIN_X], row[ORIGIN_Y], row[SPEED],
+                       int(row[AGE]), int(row[DAMAGE]), int(row[OWNER]), (int(row[R]), int(row[G]), int(row[B])))
+
+
+class BulletPool:
+    """Every live bullet on the server, stored as arrays.
+
+    Bullets fly straight, so their velocity is worked out once at spawn.
+    advance() moves, ages and expires all of them at once, and the broad
+    part of the hit tests is done for all of them at once as well. Bullets
+    are addressed by their column while a tick runs; removal only marks
+    them, compact() drops them and keeps the rest in spawn order.
+
+    Iterating gives a BulletState per bullet, which is what the snapshot
+    encoder packs.
+    """
+
+    def __init__(self, capacity=256, allocator=None):
+        self.data = np.zeros((len(FIELDS), capacity))
+        self.count = 0
+        self.ids = allocator if allocator is not None else IdAllocator()
+
+    def spawn(self, x, y, angle, player_id, speed, damage, color, lifetime=60):
+        n = self.count
+        if n == self.data.shape[1]:
+            data = np.zeros((len(FIELDS), n * 2))
+            data[:, :n] = self.data
+            self.data = data
+        rad = math.radians(angle)
+        entity_id = self.ids.allocate()
+        self.data[:, n] = (entity_id, x, y, math.cos(rad) * speed, math.sin(rad) * speed, x, y, angle, speed,
+                           damage, player_id, color[0], color[1], color[2], lifetime, 0)
+        self.count = n + 1
+        return entity_id
+
+    def advance(self):
+        """Move every bullet one frame and drop the ones whose lifetime ran out."""
+        live = self.data[:, :self.count]
+        live[X] += live[VX]
+        live[Y] += live[VY]
+        live[LIFETIME] -= 1
+        live[AGE] += 1
+        self.compact()
+
+    def select(self, mask):
+        """(column, BulletState) for the bullets where mask is set, in spawn order."""
+        columns = np.flatnonzero(mask)
+        return zip(columns.tolist(), map(_state, self.data[:, columns].T.tolist()))
+
+    def alive(self, i):
+        return self.data[LIFETIME, i] > 0
+
+    def discard(self, i):
+        """Mark the bullet in column i as gone, it is dropped by the next compact()."""
+        self.data[LIFETIME, i] = 0
+
+    def compact(self):
+        n = self.count
+        keep = self.data[LIFETIME, :n] > 0
+        if keep.all():
+            return
+        for entity_id in self.data[ID, :n][~keep].tolist():
+            self.ids.release(int(entity_id))
+        kept = int(keep.sum())
+        self.data[:, :kept] = self.data[:, :n][:, keep]  # The fancy index copies before the write
+        self.count = kept
+
+    def circle_hits(self, circles, cell_size=64):
+        """Bullets inside (x, y, radius) circles, as a per-bullet mask and {column: circle indices}.
+
+        Circles are bucketed into every grid cell their bounding box
+        overlaps and a bullet is only tested against the circles in the
+        cell under it, so the work grows with the pairs sharing a cell
+        instead of with bullets times circles. The test is the one the hit
+        loop has always made, `distance ** 0.5 < radius`, done exactly on
+        squared distances (see squared_radius). The circle indices of a
+        bullet are in ascending order. Up to DENSE_MAX pairs every bullet
+        is simply tested against every circle.
+        """
+        n = self.count
+        near = np.zeros(n, dtype=bool)
+        if not circles or not n:
+            return near, {}
+        x, y, radius = np.array(circles, dtype=float).T
+        r2 = np.array([squared_radius(r) for r in radius.tolist()])
+        live = self.data[:, :n]
+        bx, by = live[X], live[Y]
+        if n * len(circles) <= DENSE_MAX:
+            dx = bx[:, None] - x
+            dy = by[:, None] - y
+            bullet, circle = np.nonzero(dx * dx + dy * dy < r2)
+        else:
+            bullet, circle = self._cell_pairs(bx, by, x, y, radius, r2, cell_size)
+        if not len(bullet):
+            return near, {}
+        near[bullet] = True
+        # Each bullet's circles are a run of the pairs
+        first = np.flatnonzero(np.r_[True, bullet[1:] != bullet[:-1]])
+        circle = circle.tolist()
+        ends = first[1:].tolist() + [len(circle)]
+        return near, {i: circle[a:b] for i, a, b in zip(bullet[first].tolist(), first.tolist(), ends)}
+
+    @staticmethod
+    def _cell_pairs(bx, by, x, y, radius, r2, cell_size):
+        """(bullets, circles) of the hits, by bullet and then by circle, found through a grid."""
+        col0, col1 = np.floor((x - radius) / cell_size), np.floor((x + radius) / cell_size)
+        row0, row1 = np.floor((y - radius) / cell_size), np.floor((y + radius) / cell_size)
+        span_x, span_y = col1 - col0, row1 - row0
+        index = np.arange(len(x))
+        keys, owners = [], []
+        for ox in range(int(span_x.max()) + 1):
+            for oy in range(int(span_y.max()) + 1):
+                inside = (ox <= span_x) & (oy <= span_y)
+                keys.append(_cell_key(col0[inside] + ox, row0[inside] + oy))
+                owners.append(index[inside])
+        keys, owners = np.concatenate(keys), np.concatenate(owners)
+        order = np.lexsort((owners, keys))
+        keys, owners = keys[order], owners[order]
+
+        # Every (bullet, circle) pair sharing the bullet's cell, by bullet
+        # and then by circle as the entries of a cell are
+        bullet_keys = _cell_key(np.floor(bx / cell_size), np.floor(by / cell_size))
+        first = np.searchsorted(keys, bullet_keys, 'left')
+        count = np.searchsorted(keys, bullet_keys, 'right') - first
+        bullets = np.flatnonzero(count)
+        if not len(bullets):
+            return bullets, bullets
+        count = count[bullets]
+        ends = np.cumsum(count)
+        entries = np.repeat(first[bullets] - ends + count, count) + np.arange(ends[-1])
+        bullet, circle = np.repeat(bullets, count), owners[entries]
+
+        dx = bx[bullet] - x[circle]
+        dy = by[bullet] - y[circle]
+        hit = dx * dx + dy * dy < r2[circle]
+        return bullet[hit], circle[hit]
+
+    def wall_candidates(self, cells):
+        """Bullets whose way this frame touches a cell holding a wall (cells is a NavGrid or a WallCells).
+
+        A superset of those that ran into one, see wall_hit().
+        """
+        live = self.data[:, :self.count]
+        x1, y1 = live[X], live[Y]
+        x0, y0 = x1 - live[VX], y1 - live[VY]
+        return cells.rects(np.floor(np.minimum(x0, x1)), np.floor(np.minimum(y0, y1)),
+                           np.floor(np.maximum(x0, x1)), np.floor(np.maximum(y0, y1)))
+
+    def wall_hit(self, i, walls):
+        """First of walls (a WallIndex) the bullet in column i ran into this frame, as (wall, x, y), or None.
+
+        The bullet is swept from where it was to where it is, so a fast one
+        cannot skip a thin wall or cut a corner between two frames.
+        """
+        x, y, vx, vy = self.data[X:VY + 1, i].tolist()  # Adjacent rows, a view is cheaper than picking them
+        return walls.raycast(x - vx, y - vy, x, y)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        n = self.count
+        live = self.data[:, :n]
+        ints = live[[ID, AGE, DAMAGE, OWNER, R, G, B]].astype(np.int64).tolist()
+        floats = live[[X, Y, ANGLE, ORIGIN_X, ORIGIN_Y, SPEED]].tolist()
+        colors = zip(ints[4], ints[5], ints[6])
+        return map(BulletState._make, zip(ints[0], floats[0], floats[1], floats[2], floats[3], floats[4],
+                                          floats[5], ints[1], ints[2], ints[3], colors))
@@ -0,0 +1,528 @@
+import json
+import math
+import struct
+from common.game_objects import WEAPON_LIST
+
+# Wire format of a single framed message: one byte with the message type id
+# followed by the payload. Snapshots and inputs use fixed struct records,
+# the rare control messages are plain JSON. Nothing is ever unpickled.
+SNAPSHOT_VERSION = 4
+
+MESSAGE_TYPES = {
+    'game_state': 1,
+    'player_input': 2,
+    'switch_weapon': 3,
+    'switch_weapon_ack': 4,
+    'restart_game': 5,
+    'snapshot_ack': 6,
+    'map_info': 7,
+    'map_request': 8,
+    'map': 9,
+    'udp_info': 10,
+    'welcome': 11,
+}
+MESSAGE_NAMES = {type_id: name for name, type_id in MESSAGE_TYPES.items()}
+
+PICKUP_TYPES = ('health', 'armor')
+WEAPON_INDEX = {w.name: i for i, w in enumerate(WEAPON_LIST)}
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class Fixed:
+    """Float sent as a fixed-point integer: value * scale, rounded and clamped.
+
+    Encoder and decoder share the same instance, and snap() gives the value
+    the other end will see, so predicted and received state can be compared
+    exactly.
+    """
+
+    def __init__(self, fmt, scale):
+        self.fmt = fmt
+        self.scale = scale
+        bits = struct.calcsize('!' + fmt) * 8
+        if fmt.islower():
+            self.low, self.high = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+        else:
+            self.low, self.high = 0, (1 << bits) - 1
+
+    def quantize(self, value):
+        return min(max(round(value * self.scale), self.low), self.high)
+
+    def dequantize(self, q):
+        return q / self.scale
+
+    def snap(self, value):
+        return self.dequantize(self.quantize(value))
+
+
+class Angle(Fixed):
+    """Angle in degrees as a uint16 fraction of a full turn, wrapping around."""
+
+    def __init__(self):
+        super().__init__('H', 65536 / 360)
+
+    def quantize(self, value):
+        return round(value * self.scale) & 0xFFFF
+
+    def dequantize(self, q):
+        angle = q / self.scale
+        return angle - 360 if angle > 180 else angle  # Same range as atan2
+
+
+POSITION = Fixed('h', 8)  # 1/8 px, covers -4096..4096
+ANGLE = Angle()
+HEALTH = Fixed('h', 1)  # Whole points, may go negative on the killing blow
+TIMER = Fixed('B', 10)  # Tenths of a second, up to 25.5 s
+
+
+class Record:
+    """Fixed-layout struct record described by (key, struct format) pairs.
+
+    A format may also be a Fixed, which packs the float as an integer.
+    """
+
+    def __init__(self, fields):
+        self.keys = tuple(key for key, _ in fields)
+        self.struct = struct.Struct('!' + ''.join(getattr(fmt, 'fmt', fmt) for _, fmt in fields))
+        self.size = self.struct.size
+        self.fixed = tuple((i, fmt) for i, (_, fmt) in enumerate(fields) if isinstance(fmt, Fixed))
+
+    def pack(self, *values):
+        if self.fixed:
+            values = list(values)
+            for i, fixed in self.fixed:
+                values[i] = fixed.quantize(values[i])
+        return self.struct.pack(*values)
+
+    def unpack_from(self, buf, offset):
+        values = self.struct.unpack_from(buf, offset)
+        if self.fixed:
+            values = list(values)
+            for i, fixed in self.fixed:
+                values[i] = fixed.dequantize(values[i])
+        return dict(zip(self.keys, values))
+
+
+# Snapshot schema, one record layout per entity type. Bump SNAPSHOT_VERSION
+# whenever a layout changes. Positions, angles, health and timers are
+# quantized; the view casts them to ints anyway.
+HEADER = Record([
+    ('version', 'B'), ('flags', 'B'), ('tick', 'I'), ('baseline', 'I'), ('frame', 'I'),
+    ('wave', 'H'), ('wave_cooldown', 'f'),
+])
+FLAG_GAME_OVER = 0x01
+FLAG_DELTA = 0x02
+COUNT = Record([('count', 'H')])
+ENTITY_ID = Record([('id', 'I')])
+PLAYER = Record([
+    ('player_id', 'I'), ('x', POSITION), ('y', POSITION), ('angle', ANGLE),
+    ('health', HEALTH), ('armor', HEALTH), ('selected_weapon_index', 'B'),
+    ('dead', '?'), ('respawn_timer', TIMER), ('input_seq', 'I'), ('weapon_count', 'B'), ('ammo_count', 'B'),
+])
+PLAYER_WEAPON = Record([('weapon', 'B')])
+PLAYER_AMMO = Record([('weapon', 'B'), ('ammo', 'h')])
+ENEMY = Record([('x', POSITION), ('y', POSITION), ('health', HEALTH), ('type', 'B'), ('look_angle', ANGLE)])
+# Bullets never change after spawning: the record holds the spawn point and
+# frame, and the position is advanced from the snapshot's frame on decode.
+BULLET = Record([
+    ('origin_x', POSITION), ('origin_y', POSITION), ('angle', ANGLE), ('speed', 'f'), ('spawn_frame', 'I'),
+    ('player_id', 'i'), ('r', 'B'), ('g', 'B'), ('b', 'B'),
+])
+LOOTBOX = Record([('x', POSITION), ('y', POSITION), ('weapon', 'B')])
+MINE = Record([('x', POSITION), ('y', POSITION), ('owner_id', 'i'), ('damage', 'H'), ('active', '?')])
+PICKUP = Record([('x', POSITION), ('y', POSITION), ('pickup_type', 'B'), ('value', 'H')])
+# Only player-built walls travel in snapshots. Static walls come with the
+# map handshake and snapshots just report health changes by layout index.
+WALL = Record([('x', 'h'), ('y', 'h'), ('width', 'H'), ('height', 'H'), ('is_player_wall', '?'), ('health', 'h')])
+WALL_DAMAGE = Record([('health', 'h')])
+# Player ids count up for the life of the server, they need the full 32 bits
+SCORE = Record([('player_id', 'I'), ('score', 'i')])
+
+PLAYER_INPUT = Record([
+    ('seq', 'I'), ('dx', 'f'), ('dy', 'f'), ('angle', 'f'), ('shoot', '?'), ('mouse_x', 'f'), ('mouse_y', 'f'),
+])
+SNAPSHOT_ACK = Record([('tick', 'I')])
+MAP_INFO = Record([('hash', '20s')])
+
+
+def _weapon_name(index):
+    if index >= len(WEAPON_LIST):
+        raise ProtocolError(f"Unknown weapon index {index}")
+    return WEAPON_LIST[index].name
+
+
+def _as_is(data, snapshot):
+    return data
+
+
+def _decode_bullet(data, snapshot):
+    data['color'] = (data.pop('r'), data.pop('g'), data.pop('b'))
+    age = snapshot.frame - data['spawn_frame']
+    rad = math.radians(data['angle'])
+    data['x'] = data['origin_x'] + math.cos(rad) * data['speed'] * age
+    data['y'] = data['origin_y'] + math.sin(rad) * data['speed'] * age
+    return data
+
+
+def _decode_lootbox(data, snapshot):
+    data['weapon'] = _weapon_name(data['weapon'])
+    return data
+
+
+def _decode_pickup(data, snapshot):
+    if data['pickup_type'] >= len(PICKUP_TYPES):
+        raise ProtocolError(f"Unknown pickup type {data['pickup_type']}")
+    data['pickup_type'] = PICKUP_TYPES[data['pickup_type']]
+    return data
+
+
+class Section:
+    """One entity type in a snapshot: how to key, pack and unpack its records."""
+
+    def __init__(self, key, record, values, fixup=_as_is):
+        self.key = key
+        self.record = record
+        self.values = values
+        self.fixup = fixup
+
+    def entity_id(self, obj):
+        return obj.entity_id
+
+    def items(self, state):
+        items = getattr(state, self.key)
+        if isinstance(items, dict):
+            items = items.values()
+        ident = self.entity_id
+        return [(ident(item), item) for item in list(items)]
+
+    def pack(self, obj, state):
+        return self.record.pack(*self.values(obj))
+
+    def record_end(self, buf, offset):
+        return offset + self.record.size
+
+    def decode(self, record_bytes, snapshot):
+        return self.fixup(self.record.unpack_from(record_bytes, 0), snapshot)
+
+
+class PlayerSection(Section):
+    """Players carry a variable tail with their weapon list and ammo counts."""
+
+    def __init__(self):
+        super().__init__('players', PLAYER, None)
+
+    def entity_id(self, player):
+        return player.player_id
+
+    def pack(self, p, state):
+        # Copies, a pickup on the tick thread must not change the counts under us
+        weapons = list(p.weapons)
+        ammo = dict(getattr(p, 'ammo', {}))
+        parts = [PLAYER.pack(
+            p.player_id, p.x, p.y, p.angle, p.health, p.armor, p.selected_weapon_index,
+            getattr(p, 'dead', False), getattr(p, 'respawn_timer', 0), getattr(p, 'input_seq', 0),
+            len(weapons), len(ammo),
+        )]
+        parts.extend(PLAYER_WEAPON.pack(WEAPON_INDEX[w.name]) for w in weapons)
+        parts.extend(PLAYER_AMMO.pack(WEAPON_INDEX[name], count) for name, count in ammo.items())
+        return b''.join(parts)
+
+    def record_end(self, buf, offset):
+        header = PLAYER.unpack_from(buf, offset)
+        return (offset + PLAYER.size + header['weapon_count'] * PLAYER_WEAPON.size
+                + header['ammo_count'] * PLAYER_AMMO.size)
+
+    def decode(self, record_bytes, snapshot):
+        data = PLAYER.unpack_from(record_bytes, 0)
+        offset = PLAYER.size
+        weapons = []
+        for _ in range(data.pop('weapon_count')):
+            weapons.append(_weapon_name(PLAYER_WEAPON.unpack_from(record_bytes, offset)['weapon']))
+            offset += PLAYER_WEAPON.size
+        ammo = {}
+        for _ in range(data.pop('ammo_count')):
+            entry = PLAYER_AMMO.unpack_from(record_bytes, offset)
+            ammo[_weapon_name(entry['weapon'])] = entry['ammo']
+            offset += PLAYER_AMMO.size
+        data['weapons'] = weapons
+        data['ammo'] = ammo
+        return data
+
+
+class BulletSection(Section):
+    def __init__(self):
+        super().__init__('bullets', BULLET, None, _decode_bullet)
+
+    def pack(self, b, state):
+        return BULLET.pack(b.origin_x, b.origin_y, b.angle, b.speed, state.frame - b.age, b.player_id,
+                           *getattr(b, 'color', (255, 255, 0)))
+
+
+class PlayerWallSection(Section):
+    def __init__(self):
+        super().__init__('walls', WALL,
+                         lambda w: (w.rect.x, w.rect.y, w.rect.width, w.rect.height, w.is_player_wall, w.health))
+
+    def items(self, state):
+        return [(w.entity_id, w) for w in list(state.walls) if w.is_player_wall]
+
+
+class WallDamageSection(Section):
+    """Health of damaged or destroyed static walls, keyed by layout index."""
+
+    def __init__(self):
+        super().__init__('wall_damage', WALL_DAMAGE, lambda w: (max(w.health, 0),))
+
+    def items(self, state):
+        layout = getattr(state, 'map_layout', None)
+        if layout is None:
+            return []
+        return [(i, w) for i, w in enumerate(layout.walls) if w.health != w.max_health]
+
+
+SECTIONS = (
+    PlayerSection(),
+    Section('enemies', ENEMY,
+            lambda e: (e.x, e.y, e.health, getattr(e, 'type', 1), getattr(e, 'look_angle', 0))),
+    BulletSection(),
+    Section('lootboxes', LOOTBOX,
+            lambda l: (l.x, l.y, WEAPON_INDEX[l.weapon.name]),
+            _decode_lootbox),
+    Section('mines', MINE,
+            lambda m: (m.x, m.y, m.owner_id, m.damage, m.active)),
+    Section('pickups', PICKUP,
+            lambda p: (p.x, p.y, PICKUP_TYPES.index(p.pickup_type), p.value),
+            _decode_pickup),
+    PlayerWallSection(),
+    WallDamageSection(),
+)
+
+
+class Snapshot:
+    """Encoded world state at one tick: packed record bytes per entity id.
+
+    Keeping every entity as its own bytes object makes deltas a plain
+    comparison of records against the baseline snapshot.
+    """
+
+    def __init__(self, tick, frame, game_over, wave, wave_cooldown, scores, sections):
+        self.tick = tick
+        self.frame = frame
+        self.game_over = game_over
+        self.wave = wave
+        self.wave_cooldown = wave_cooldown
+        self.scores = scores
+        self.sections = sections
+
+    @classmethod
+    def from_state(cls, state, tick):
+        sections = {}
+        for section in SECTIONS:
+            pack = section.pack
+            sections[section.key] = {ident: pack(item, state) for ident, item in section.items(state)}
+        return cls(tick, state.frame, state.game_over, state.wave, state.wave_cooldown,
+                   dict(state.scores), sections)
+
+    def subset(self, visible, filtered):
+        """Same snapshot limited to the visible (section key, id) pairs.
+
+        Sections not in filtered are kept whole. Record bytes are shared
+        with this snapshot, nothing is packed again. Visible ids this
+        snapshot has no record of, entities spawned after it was packed,
+        are left out.
+        """
+        sections = {key: ({} if key in filtered else records) for key, records in self.sections.items()}
+        for key, entity_id in visible:
+            record = self.sections[key].get(entity_id)
+            if record is not None:
+                sections[key][entity_id] = record
+        return Snapshot(self.tick, self.frame, self.game_over, self.wave, self.wave_cooldown,
+                        self.scores, sections)
+
+    def to_dict(self):
+        """Decode into the dict layout consumed by GameState.from_dict."""
+        data = {
+            'tick': self.tick,
+            'frame': self.frame,
+            'game_over': self.game_over,
+            'wave': self.wave,
+            'wave_cooldown': self.wave_cooldown,
+            'scores': dict(self.scores),
+        }
+        for section in SECTIONS:
+            records = self.sections[section.key]
+            if section.key == 'players':
+                data['players'] = {pid: section.decode(r, self) for pid, r in records.items()}
+                continue
+            items = []
+            for entity_id, record_bytes in records.items():
+                item = section.decode(record_bytes, self)
+                item['id'] = entity_id
+                items.append(item)
+            data[section.key] = items
+        return data
+
+
+class SnapshotHistory:
+    """The last few snapshots by tick, used as delta baselines on both ends."""
+
+    def __init__(self, size=32):
+        self.size = size
+        self.snapshots = {}
+
+    def add(self, snapshot):
+        self.snapshots[snapshot.tick] = snapshot
+        while len(self.snapshots) > self.size:
+            del self.snapshots[min(self.snapshots)]
+
+    def get(self, tick):
+        return self.snapshots.get(tick)
+
+
+def encode_snapshot(snapshot, baseline=None):
+    """Pack a snapshot, as a delta against baseline when one is given.
+
+    A delta lists, per entity type, the ids removed since the baseline and
+    the records that were created or changed. Without a baseline every
+    record is sent and the client replaces its state wholesale.
+    """
+    flags = FLAG_GAME_OVER if snapshot.game_over else 0
+    if baseline is not None:
+        flags |= FLAG_DELTA
+    parts = [HEADER.pack(SNAPSHOT_VERSION, flags, snapshot.tick,
+                         baseline.tick if baseline is not None else 0, snapshot.frame,
+                         snapshot.wave, snapshot.wave_cooldown)]
+    pack_id = ENTITY_ID.struct.pack
+    for section in SECTIONS:
+        records = snapshot.sections[section.key]
+        if baseline is None:
+            removed = ()
+            changed = records.items()
+        else:
+            base = baseline.sections[section.key]
+            removed = [entity_id for entity_id in base if entity_id not in records]
+            changed = [(entity_id, r) for entity_id, r in records.items() if base.get(entity_id) != r]
+        parts.append(COUNT.pack(len(removed)))
+        parts.extend(pack_id(entity_id) for entity_id in removed)
+        parts.append(COUNT.pack(len(changed)))
+        for entity_id, record_bytes in changed:
+            parts.append(pack_id(entity_id))
+            parts.append(record_bytes)
+    scores = list(snapshot.scores.items())
+    parts.append(COUNT.pack(len(scores)))
+    parts.extend(SCORE.pack(pid, score) for pid, score in scores)
+    return b''.join(parts)
+
+
+class SnapshotDecoder:
+    """Client-side counterpart of encode_snapshot that resolves deltas."""
+
+    def __init__(self, history_size=32):
+        self.history = SnapshotHistory(history_size)
+        self.last_tick = 0
+        self.ack_tick = 0  # What to acknowledge back; 0 requests a full snapshot
+
+    def decode(self, buf, offset=0):
+        """Return the decoded Snapshot, or None when its baseline is unknown."""
+        try:
+            header = HEADER.unpack_from(buf, offset)
+            if header['version'] != SNAPSHOT_VERSION:
+                raise ProtocolError(f"Unsupported snapshot version {header['version']}")
+            offset += HEADER.size
+            if header['tick'] <= self.last_tick:
+                return None  # Stale or duplicate
+            baseline = None
+            if header['flags'] & FLAG_DELTA:
+                baseline = self.history.get(header['baseline'])
+                if baseline is None:
+                    self.ack_tick = 0  # Ask the server for a full snapshot
+                    return None
+
+            sections = {}
+            for section in SECTIONS:
+                records = dict(baseline.sections[section.key]) if baseline is not None else {}
+                count = COUNT.unpack_from(buf, offset)['count']
+                offset += COUNT.size
+                for _ in range(count):
+                    records.pop(ENTITY_ID.unpack_from(buf, offset)['id'], None)
+                    offset += ENTITY_ID.size
+                count = COUNT.unpack_from(buf, offset)['count']
+                offset += COUNT.size
+                for _ in range(count):
+                    entity_id = ENTITY_ID.unpack_from(buf, offset)['id']
+                    offset += ENTITY_ID.size
+                    end = section.record_end(buf, offset)
+                    if end > len(buf):
+                        raise ProtocolError("Truncated snapshot record")
+                    records[entity_id] = bytes(buf[offset:end])
+                    offset = end
+                sections[section.key] = records
+
+            scores = {}
+            count = COUNT.unpack_from(buf, offset)['count']
+            offset += COUNT.size
+            for _ in range(count):
+                entry = SCORE.unpack_from(buf, offset)
+                scores[entry['player_id']] = entry['score']
+                offset += SCORE.size
+        except struct.error as e:
+            raise ProtocolError(f"Truncated snapshot: {e}")
+
+        snapshot = Snapshot(header['tick'], header['frame'], bool(header['flags'] & FLAG_GAME_OVER),
+                            header['wave'], header['wave_cooldown'], scores, sections)
+        self.history.add(snapshot)
+        self.last_tick = self.ack_tick = snapshot.tick
+        return snapshot
+
+
+def pack_input(data):
+    return PLAYER_INPUT.pack(data['seq'], data['dx'], data['dy'], data['angle'], data['shoot'],
+                             data['mouse_x'], data['mouse_y'])
+
+
+def encode_message(message_type, data):
+    type_id = MESSAGE_TYPES.get(message_type)
+    if type_id is None:
+        raise ProtocolError(f"Unknown message type {message_type!r}")
+    if message_type == 'game_state':
+        payload = data  # Already packed with encode_snapshot
+    elif message_type == 'snapshot_ack':
+        payload = SNAPSHOT_ACK.pack(data['tick'])
+    elif message_type == 'map_info':
+        payload = MAP_INFO.pack(data['hash'])
+    elif message_type == 'map':
+        payload = data  # MapLayout.data
+    elif message_type == 'player_input':
+        payload = pack_input(data)
+    else:
+        payload = json.dumps(data).encode('utf-8')
+    return bytes((type_id,)) + payload
+
+
+_BINARY_MESSAGES = {'player_input': PLAYER_INPUT, 'snapshot_ack': SNAPSHOT_ACK, 'map_info': MAP_INFO}
+
+
+def decode_message(buf):
+    if not buf:
+        raise ProtocolError("Empty message")
+    message_type = MESSAGE_NAMES.get(buf[0])
+    if message_type is None:
+        raise ProtocolError(f"Unknown message type id {buf[0]}")
+    if message_type in ('game_state', 'map'):
+        data = buf[1:]  # Resolved by SnapshotDecoder and MapLayout.decode
+    elif message_type in _BINARY_MESSAGES:
+        record = _BINARY_MESSAGES[message_type]
+        if len(buf) - 1 != record.size:
+            raise ProtocolError(f"Malformed {message_type} message")
+        data = record.unpack_from(buf, 1)
+    else:
+        try:
+            data = json.loads(bytes(buf[1:]).decode('utf-8'))
+        except ValueError as e:
+            raise ProtocolError(f"Malformed {message_type} message: {e}")
+        if not isinstance(data, dict):
+            raise ProtocolError(f"Malformed {message_type} message")
+    return {'type': message_type, 'data': data}
@@ -0,0 +1,137 @@
+import asyncio
+import collections
+import threading
+from common.network import NetworkProtocol
+
+
+class SendQueue:
+    """Outgoing frames for one client.
+
+    Control messages (acks, map data) are never dropped. Snapshots wait in a
+    small bounded queue and, when the client falls behind, the oldest ones
+    are discarded so it always catches up on the newest state. Deltas are
+    computed against the last acked snapshot, so a dropped frame costs
+    nothing but the bytes that were never sent.
+    """
+
+    def __init__(self, max_snapshots=2):
+        self.control = collections.deque()
+        self.snapshots = collections.deque()
+        self.max_snapshots = max_snapshots
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self.control) + len(self.snapshots)
+
+    def push_control(self, frame):
+        self.control.append(frame)
+        self.max_depth = max(self.max_depth, len(self))
+
+    def push_snapshot(self, frame):
+        if len(self.snapshots) >= self.max_snapshots:
+            self.snapshots.popleft()
+            self.dropped_frames += 1
+        self.snapshots.append(frame)
+        self.max_depth = max(self.max_depth, len(self))
+
+    def pop(self):
+        if self.control:
+            return self.control.popleft()
+        if self.snapshots:
+            return self.snapshots.popleft()
+        return None
+
+    def stats(self):
+        return {
+            'queue_depth': len(self),
+            'max_queue_depth': self.max_depth,
+            'sent_frames': self.sent_frames,
+            'dropped_frames': self.dropped_frames,
+        }
+
+
+class ClientConnection:
+    """Socket plus a sender thread that drains its SendQueue.
+
+    A client on a congested link only blocks its own sender thread, never
+    the broadcast loop.
+    """
+
+    def __init__(self, sock, max_snapshots=2):
+        self.sock = sock
+        self.queue = SendQueue(max_snapshots)
+        self.ready = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def send(self, message):
+        with self.ready:
+            self.queue.push_control(NetworkProtocol.frame_message(message))
+            self.ready.notify()
+
+    def send_snapshot(self, frame):
+        # Frames come from SnapshotFrames and are shared with other clients
+        with self.ready:
+            self.queue.push_snapshot(frame)
+            self.ready.notify()
+
+    def _drain(self):
+        while True:
+            with self.ready:
+                while not self.closed and not self.queue:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                frame = self.queue.pop()
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                self.close()
+                return
+            self.queue.sent_frames += 1
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+
+class AsyncClientConnection:
+    """Event loop counterpart of ClientConnection, drained by its own task."""
+
+    def __init__(self, writer, max_snapshots=2):
+        self.writer = writer
+        self.queue = SendQueue(max_snapshots)
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.task = asyncio.create_task(self._drain())
+
+    def send(self, message):
+        self.queue.push_control(NetworkProtocol.frame_message(message))
+        self.ready.set()
+
+    def send_snapshot(self, frame):
+        self.queue.push_snapshot(frame)
+        self.ready.set()
+
+    async def _drain(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                while not self.closed:
+                    frame = self.queue.pop()
+                    if frame is None:
+                        break
+                    self.writer.write(frame)
+                    await self.writer.drain()  # Waits only while this client's socket is backed up
+                    self.queue.sent_frames += 1
+        except (ConnectionError, OSError):
+            self.closed = True
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
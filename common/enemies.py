@@ -0,0 +1,76 @@
+import math
+import numpy as np
+
+SHOOTING_RANGE = 300  # Shooters stop and fire at a player closer than this
+# Fewer enemies than this are cheaper to test against the walls one by one
+BROADPHASE_MIN = 32
+
+
+class EnemySteering:
+    """Where every enemy heads this frame, worked out for all of them at once.
+
+    Enemies follow the flow field towards the nearest live player and go
+    straight for their target once they are in its cell. Shooters stop and
+    fire at a target in range only if they can see it. Takes the
+    enemies' positions at the start of the enemy update. Each enemy only
+    moves itself and players do not move during it, so the positions stay
+    valid for every enemy still to come. Only the set of live players can
+    change, when an enemy kills one, and then plan() is simply run again
+    for the rest.
+    """
+
+    def __init__(self, enemies):
+        columns = np.array([(e.x, e.y, e.speed, e.size, e._is_shooter) for e in enemies], dtype=float)
+        self.x, self.y, self.speed, self.size, shooter = columns.reshape(-1, 5).T
+        self.shooter = shooter.astype(bool)
+        self.width = 2 * self.size
+
+    def plan(self, players, start, dt, cells, flow, sight):
+        """Steering of enemies[start:] towards the nearest of players, which are all alive.
+
+        flow is the FlowField to follow and sight the LineOfSight shooters
+        check before they stop to shoot. The target is the nearest player in
+        a straight line, the one a shooter aims at and an enemy can touch.
+        Returns lists with, per enemy: the index of its target in players,
+        whether it stands and shoots, its look angle in degrees, its move
+        in x and y this frame, and whether that move stays clear of every
+        cell with a wall in cells (a WallCells), so it needs no collision
+        test. Below BROADPHASE_MIN enemies no move is reported clear.
+        """
+        x, y, speed, size = self.x[start:], self.y[start:], self.speed[start:], self.size[start:]
+        px = np.array([p.x for p in players], dtype=float)
+        py = np.array([p.y for p in players], dtype=float)
+        distance = np.sqrt((px - x[:, None]) ** 2 + (py - y[:, None]) ** 2)
+        target = distance.argmin(axis=1)  # First of equally near players, like min()
+        shooting = self.shooter[start:] & (distance.min(axis=1) < SHOOTING_RANGE)
+        if shooting.any():
+            # Shooters behind a wall keep coming round it instead
+            for k in np.flatnonzero(shooting).tolist():
+                t = target[k]
+                shooting[k] = sight.clear(float(x[k]), float(y[k]), float(px[t]), float(py[t]))
+
+        # Go the way the flow field points, shooters face their target.
+        # Angles come from math like everywhere else in the simulation,
+        # NumPy's atan2 can round the last bit differently.
+        step_x, step_y, follow = flow.direction(x, y)
+        follow &= ~shooting
+        way_x = np.where(follow, step_x, px[target] - x)
+        way_y = np.where(follow, step_y, py[target] - y)
+        angles = list(map(math.atan2, way_y.tolist(), way_x.tolist()))
+        move_x = np.where(shooting, 0, np.array(list(map(math.cos, angles))) * speed) * dt
+        move_y = np.where(shooting, 0, np.array(list(map(math.sin, angles))) * speed) * dt
+
+        # Covers the rects of the X step and of the Y step after it; a pixel
+        # of margin keeps it a superset however pygame rounds the corners
+        left = np.floor(x + move_x - size) - 1
+        step_y = y + move_y
+        top = np.floor(np.minimum(y, step_y) - size) - 1
+        bottom = np.floor(np.maximum(y, step_y) - size) + 1
+        if len(x) >= BROADPHASE_MIN:
+            width = self.width[start:]
+            clear = ~cells.rects(left, top, left + width + 2, bottom + width)
+        else:
+            clear = np.zeros(len(x), dtype=bool)
+
+        return (target.tolist(), shooting.tolist(), list(map(math.degrees, angles)),
+                move_x.tolist(), move_y.tolist(), clear.tolist())
@@ -134,12 +134,17 @@ class Player:
 
 class Bullet:
     def __init__(self, x, y, angle, player_id, weapon=None):
+        self.entity_id = 0  # Set by the registry the entity is added to, 0 is never a valid id
         self.x = x
         self.y = y
         self.angle = angle
         self.player_id = player_id
         self.size = 5
         self.lifetime = 60  # frames
+        # Bullets fly straight, so spawn point and age pin down the position
+        self.origin_x = x
+        self.origin_y = y
+        self.age = 0
         if weapon:
             self.speed = weapon.bullet_speed
             self.damage = weapon.damage
@@ -153,6 +158,7 @@ class Bullet:
         self.x += math.cos(math.radians(self.angle)) * self.speed
         self.y += math.sin(math.radians(self.angle)) * self.speed
         self.lifetime -= 1
+        self.age += 1
 
     def draw(self, screen, camera_offset=(0,0)):
         cx, cy = camera_offset
@@ -160,6 +166,7 @@ class Bullet:
 
 class Enemy:
     def __init__(self, x, y, enemy_type=1):
+        self.entity_id = 0
         self.x = x
         self.y = y
         self.type = enemy_type
@@ -278,6 +285,7 @@ class Enemy:
 
 class Wall:
     def __init__(self, x, y, width, height, is_player_wall=False, health=100):
+        self.entity_id = 0
         self.rect = pygame.Rect(x, y, width, height)
         self.is_player_wall = is_player_wall
         self.health = health
@@ -296,6 +304,7 @@ class Wall:
 
 class LootBox:
     def __init__(self, x, y, weapon=None):
+        self.entity_id = 0
         self.x = x
         self.y = y
         self.size = 15
@@ -311,6 +320,7 @@ class LootBox:
 
 class Mine:
     def __init__(self, x, y, owner_id, damage=50):
+        self.entity_id = 0
         self.x = x
         self.y = y
         self.size = 10
@@ -329,6 +339,7 @@ class Mine:
 
 class Pickup:
     def __init__(self, x, y, pickup_type='health', value=50):
+        self.entity_id = 0
         self.x = x
         self.y = y
         self.pickup_type = pickup_type
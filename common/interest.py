@@ -0,0 +1,55 @@
+from common.spatial import UniformGrid
+
+# Sections filtered by distance to the client's camera. Players and static
+# wall damage are always sent: they are few and feed the HUD.
+INTEREST_SECTIONS = ('enemies', 'bullets', 'lootboxes', 'mines', 'pickups', 'walls')
+
+
+def entity_position(obj):
+    rect = getattr(obj, 'rect', None)
+    if rect is not None:
+        return rect.centerx, rect.centery
+    return obj.x, obj.y
+
+
+def build_interest_index(state, sections):
+    """Spatial index of every filtered entity, keyed by (section key, entity id)."""
+    index = UniformGrid()
+    for section in sections:
+        if section.key not in INTEREST_SECTIONS:
+            continue
+        for entity_id, obj in section.items(state):
+            x, y = entity_position(obj)
+            index.insert((section.key, entity_id), x, y)
+    return index
+
+
+class InterestArea:
+    """The part of the world one client is told about.
+
+    Entities enter once they are inside the client's viewport plus margin
+    and only leave once they are hysteresis further out, so anything
+    hovering at the edge does not pop in and out every snapshot.
+    """
+
+    def __init__(self, half_width=400, half_height=300, margin=100, hysteresis=100):
+        self.half_width = half_width
+        self.half_height = half_height
+        self.margin = margin
+        self.hysteresis = hysteresis
+        self.visible = set()
+
+    def update(self, index, x, y):
+        w = self.half_width + self.margin
+        h = self.half_height + self.margin
+        visible = set(index.query_rect(x - w, y - h, x + w, y + h))
+        w += self.hysteresis
+        h += self.hysteresis
+        positions = index.positions
+        for key in self.visible:
+            if key not in visible:
+                position = positions.get(key)
+                if position is not None and abs(position[0] - x) <= w and abs(position[1] - y) <= h:
+                    visible.add(key)
+        self.visible = visible
+        return visible
@@ -0,0 +1,115 @@
+import collections
+import math
+
+TICK_RATE = 60  # Default server simulation frames per second, snapshots are stamped with the frame
+TELEPORT_DISTANCE = 100  # Respawns and the like snap instead of sliding across the map
+
+
+def _lerp_angle(a, b, t):
+    diff = (b - a + 180) % 360 - 180
+    return a + diff * t
+
+
+class SnapshotBuffer:
+    """Received states, rendered render_delay seconds in the past.
+
+    Players and enemies are interpolated between the two snapshots around
+    the render time. If the newer one has not arrived yet their motion is
+    extrapolated for at most max_extrapolation seconds, then they hold.
+    Bullets fly straight, so they are simply placed at the render time.
+    tick_rate is the server's, snapshot frames are converted to time with it.
+
+    The client applies every snapshot to one live state as it arrives, so
+    which entities exist is taken from the buffered snapshots too: an entity
+    is drawn from the render time of the first snapshot that has it until
+    that of the first one that no longer does.
+    """
+
+    DRAWN = ('enemies', 'bullets', 'lootboxes', 'mines', 'pickups')  # Sections sample() returns
+
+    def __init__(self, render_delay=0.1, max_extrapolation=0.1, size=32, tick_rate=TICK_RATE):
+        self.render_delay = render_delay
+        self.max_extrapolation = max_extrapolation
+        self.tick_rate = tick_rate
+        self.states = collections.deque(maxlen=size)  # (server time, entities)
+        self.clock_offset = None  # Local time minus server time, smoothed
+
+    def add(self, state, received_at):
+        server_time = state.frame / self.tick_rate
+        if self.states and server_time <= self.states[-1][0]:
+            return
+        sample = received_at - server_time
+        if self.clock_offset is None or abs(sample - self.clock_offset) > 0.25:
+            self.clock_offset = sample
+        else:
+            # Smooth out network jitter, follow slow drift of the server's frame rate
+            self.clock_offset += (sample - self.clock_offset) * 0.05
+        self.states.append((server_time, self._entities(state)))
+
+    @staticmethod
+    def _entities(state):
+        # Snapshot values, kept aside because sample() moves the objects and
+        # the live state moves on; the objects stay drawable after they left it
+        entities = {}
+        for pid, p in state.players.items():
+            entities['players', pid] = (p, p.x, p.y, p.angle, 'angle')
+        for e in state.enemies:
+            entities['enemies', e.entity_id] = (e, e.x, e.y, e.look_angle, 'look_angle')
+        for b in state.bullets:
+            entities['bullets', b.entity_id] = (b, state.frame - b.age)  # Spawn frame
+        for key in ('lootboxes', 'mines', 'pickups'):
+            for obj in getattr(state, key):
+                entities[key, obj.entity_id] = (obj,)
+        return entities
+
+    def sample(self, now):
+        """Entities to draw at local time now by section, or None before the first snapshot.
+
+        Players are moved but not listed, every player in the live state is drawn.
+        """
+        if not self.states:
+            return None
+        render_time = now - self.clock_offset - self.render_delay
+        while len(self.states) > 2 and self.states[1][0] <= render_time:
+            self.states.popleft()
+
+        if len(self.states) == 1 or render_time <= self.states[0][0]:
+            older = newer = self.states[0]
+        else:
+            older, newer = self.states[0], self.states[1]
+        newer_time = newer[0]
+        if older is newer:
+            t = 0
+        else:
+            span = newer_time - older[0]
+            # Past the newest snapshot: keep going along the last motion, but not for long
+            target = min(render_time, newer_time + self.max_extrapolation)
+            t = (target - older[0]) / span
+        old_entities, new_entities = older[1], newer[1]
+        # Entities as of the render time: spawned later are not there yet, removed since still are
+        current = new_entities if render_time >= newer_time else old_entities
+        bullet_frame = min(render_time, newer_time + self.max_extrapolation) * self.tick_rate
+
+        drawn = {key: [] for key in self.DRAWN}
+        for key, entry in current.items():
+            obj = entry[0]
+            if key[0] != 'players':
+                drawn[key[0]].append(obj)
+            if key[0] == 'bullets':
+                # Never drawn behind the point it was fired from
+                age = max(0, bullet_frame - entry[1])
+                rad = math.radians(obj.angle)
+                obj.x = obj.origin_x + math.cos(rad) * obj.speed * age
+                obj.y = obj.origin_y + math.sin(rad) * obj.speed * age
+                continue
+            if len(entry) == 1:
+                continue  # Lootboxes, mines and pickups stay where they are
+            old, new = old_entities.get(key), new_entities.get(key)
+            if old is None or new is None or older is newer or math.hypot(new[1] - old[1], new[2] - old[2]) > TELEPORT_DISTANCE:
+                _, obj.x, obj.y, angle, angle_attr = entry
+                setattr(obj, angle_attr, angle)
+                continue
+            obj.x = old[1] + (new[1] - old[1]) * t
+            obj.y = old[2] + (new[2] - old[2]) * t
+            setattr(obj, new[4], _lerp_angle(old[3], new[3], t))
+        return drawn
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import struct
+from common.game_objects import Wall
+
+MAP_WALL = struct.Struct('!hhHHh')  # x, y, width, height, health
+MAP_COUNT = struct.Struct('!H')
+MAP_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'boxhead', 'maps')
+
+
+class MapLayout:
+    """Static walls of a map, sent once per connection instead of per snapshot.
+
+    Walls are addressed by their index in the layout, which is what
+    snapshots use to report damage to them.
+    """
+
+    def __init__(self, walls):
+        self.walls = walls
+        self.data = self.encode(walls)
+        self.hash = hashlib.sha1(self.data).digest()
+
+    @staticmethod
+    def encode(walls):
+        parts = [MAP_COUNT.pack(len(walls))]
+        for w in walls:
+            parts.append(MAP_WALL.pack(w.rect.x, w.rect.y, w.rect.width, w.rect.height, w.max_health))
+        return b''.join(parts)
+
+    @classmethod
+    def decode(cls, data):
+        data = bytes(data)
+        count = MAP_COUNT.unpack_from(data, 0)[0]
+        if len(data) != MAP_COUNT.size + count * MAP_WALL.size:
+            raise ValueError("Malformed map layout")
+        walls = []
+        for i in range(count):
+            x, y, width, height, health = MAP_WALL.unpack_from(data, MAP_COUNT.size + i * MAP_WALL.size)
+            walls.append(Wall(x, y, width, height, False, health))
+        return cls(walls)
+
+    def apply_damage(self, damage):
+        """Sync wall health from a snapshot and return the walls still standing."""
+        standing = []
+        for index, wall in enumerate(self.walls):
+            wall.health = damage.get(index, wall.max_health)
+            if wall.health > 0:
+                standing.append(wall)
+        return standing
+
+
+class MapCache:
+    """On-disk cache of map layouts keyed by their content hash."""
+
+    def __init__(self, directory=MAP_CACHE_DIR):
+        self.directory = directory
+
+    def _path(self, map_hash):
+        return os.path.join(self.directory, map_hash.hex() + '.map')
+
+    def load(self, map_hash):
+        try:
+            with open(self._path(map_hash), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if hashlib.sha1(data).digest() != map_hash:
+            return None
+        return MapLayout.decode(data)
+
+    def store(self, layout):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(layout.hash), 'wb') as f:
+                f.write(layout.data)
+        except OSError as e:
+            print(f"Could not cache map {layout.hash.hex()}: {e}")
@@ -0,0 +1,25 @@
+import pygame
+from common.codec import POSITION
+
+# Player movement shared by the server simulation and client-side prediction.
+# Both ends must run exactly this code on exactly the same inputs, or the
+# client's predicted position drifts from the server's.
+INPUT_RATE = 60  # Inputs per second; one input is one simulation step
+MAX_INPUTS_PER_TICK = 4  # Catch-up limit after a burst of late inputs
+
+
+def move_player(x, y, dx, dy, speed, size, walls):
+    """New (x, y) after one step of input, stopped by walls (a WallIndex)."""
+    # Normalize diagonal movement
+    if dx != 0 and dy != 0:
+        dx *= 0.7071
+        dy *= 0.7071
+
+    # Ruch gracza z kolizją ścian
+    new_x = x + dx * speed
+    new_y = y + dy * speed
+    player_rect = pygame.Rect(new_x - size, new_y - size, size*2, size*2)
+    if walls.collide_rect(player_rect) is not None:
+        return x, y
+    # Kept on the snapshot grid, so the client sees the exact position it has to replay from
+    return POSITION.snap(new_x), POSITION.snap(new_y)
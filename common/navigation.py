@@ -0,0 +1,268 @@
+import heapq
+import math
+import numpy as np
+
+# Neighbour steps (dx, dy) on the grid, orthogonal ones first
+STEPS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1))
+
+FREE_COST = 1.0
+NEAR_WALL_COST = 3.0  # Passable, but paths keep to the middle of corridors
+PLAYER_WALL_COST = 12.0  # Breaking through beats a detour of about this many cells
+
+
+class NavGrid:
+    """Cost of crossing each cell of the map, kept in step with a WallIndex.
+
+    Map walls block the cells they cover, player walls make them
+    expensive and cells near any wall cost a little more. Each cell
+    counts the walls that cover it and come near it, so a wall is applied
+    and taken back one at a time: sync() catches up from the WallIndex
+    change log and only redoes the cells around each wall built or
+    destroyed since, rebuilding everything only when the log has moved
+    on. Structures built on top only learn from version that the grid
+    changed, not where: the flow field is searched whole again, there is
+    no patching of just the paths through the cells a wall touched.
+
+    bounds is (left, top, right, bottom) of the area covered. The grid has
+    a ring of blocked cells around it, so the arrays are padded by one
+    cell on each side and cell (row, col) is at [row + 1, col + 1].
+    """
+
+    def __init__(self, bounds, cell_size=20, clearance=20, beyond=None):
+        left, top, right, bottom = bounds
+        self.beyond = beyond  # A WallCells to ask about rects reaching outside the grid
+        self.left, self.top = left, top
+        self.cell_size = cell_size
+        self.clearance = clearance  # Cells closer than this to a wall cost NEAR_WALL_COST
+        self.width = math.ceil((right - left) / cell_size)
+        self.height = math.ceil((bottom - top) / cell_size)
+        # Per bound of a rect (left, right, top, bottom), for rects()
+        self.origin = np.array([[left], [left], [top], [top]])
+        self.last = np.array([[self.width + 1], [self.width + 1], [self.height + 1], [self.height + 1]])
+        self.walls_version = None
+        self.version = 0  # Bumped whenever costs change
+
+    def _cells(self, x0, y0, x1, y1):
+        # Padded cell bounds (row0, row1, col0, col1) overlapping [x0, x1) x [y0, y1)
+        cs = self.cell_size
+        c0 = min(max(math.floor((x0 - self.left) / cs), -1), self.width) + 1
+        c1 = min(max(math.ceil((x1 - self.left) / cs), -1), self.width) + 1
+        r0 = min(max(math.floor((y0 - self.top) / cs), -1), self.height) + 1
+        r1 = min(max(math.ceil((y1 - self.top) / cs), -1), self.height) + 1
+        return r0, r1, c0, c1
+
+    def _apply(self, wall, count):
+        # Counts one wall in (count 1) or out (-1), returns the padded cells it reaches
+        r = wall.rect
+        cl = self.clearance
+        r0, r1, c0, c1 = self._cells(r.x - cl, r.y - cl, r.right + cl, r.bottom + cl)
+        self.near[r0:r1, c0:c1] += count
+        s0, s1, t0, t1 = self._cells(r.x, r.y, r.right, r.bottom)
+        (self.barricades if wall.is_player_wall else self.solid)[s0:s1, t0:t1] += count
+        if (r.x < self.left or r.y < self.top or r.right > self.left + self.width * self.cell_size
+                or r.bottom > self.top + self.height * self.cell_size):
+            self.outside += count
+        return r0, r1, c0, c1
+
+    def _rebuild(self, walls):
+        shape = (self.height + 2, self.width + 2)
+        self.solid = np.zeros(shape, dtype=np.int32)  # Map walls covering each cell
+        self.barricades = np.zeros(shape, dtype=np.int32)  # Player walls covering it
+        self.near = np.zeros(shape, dtype=np.int32)  # Walls closer than clearance
+        self.cost = np.full(shape, np.inf)
+        self.blocked = np.ones(shape, dtype=bool)
+        self.covered = np.zeros(shape, dtype=bool)  # Any wall in the cell, on the ring any wall outside the grid
+        self.outside = 0  # Walls reaching outside the grid
+        self.weights = [np.full(shape, np.inf) for _ in STEPS]
+        stride = self.width + 2
+        self.steps = [(dy * stride + dx, weight.ravel().tolist()) for (dx, dy), weight in zip(STEPS, self.weights)]
+        for wall in walls.order:
+            self._apply(wall, 1)
+        self._reweigh(1, self.height + 1, 1, self.width + 1)
+
+    def _reweigh(self, r0, r1, c0, c1):
+        # Costs of the padded cells [r0, r1) x [c0, c1), then the weights of
+        # every step that starts or ends there or cuts one of their corners
+        r0, r1, c0, c1 = max(r0, 1), min(r1, self.height + 1), max(c0, 1), min(c1, self.width + 1)
+        if r0 >= r1 or c0 >= c1:
+            return
+        area = (slice(r0, r1), slice(c0, c1))
+        self.blocked[area] = self.solid[area] > 0
+        self.covered[area] = self.blocked[area] | (self.barricades[area] > 0)
+        self.cost[area] = np.where(self.barricades[area] > 0, PLAYER_WALL_COST,
+                                   np.where(self.near[area] > 0, NEAR_WALL_COST, FREE_COST))
+
+        # Weight of the step from a cell in each direction: the mean cost of
+        # both cells times the step length. Same both ways, so distances from
+        # the players are also distances to them. No cutting corners.
+        r0, r1, c0, c1 = max(r0 - 1, 1), min(r1 + 1, self.height + 1), max(c0 - 1, 1), min(c1 + 1, self.width + 1)
+        cost, blocked = self.cost, self.blocked
+        stride = self.width + 2
+        here = (slice(r0, r1), slice(c0, c1))
+        for (dx, dy), padded, (_, flat) in zip(STEPS, self.weights, self.steps):
+            to = (slice(r0 + dy, r1 + dy), slice(c0 + dx, c1 + dx))
+            weight = (cost[here] + cost[to]) / 2 * (math.sqrt(2) if dx and dy else 1)
+            closed = blocked[here] | blocked[to]
+            if dx and dy:
+                closed |= blocked[r0:r1, c0 + dx:c1 + dx] | blocked[r0 + dy:r1 + dy, c0:c1]
+            weight[closed] = np.inf
+            padded[here] = weight
+            for row, values in zip(range(r0, r1), weight.tolist()):
+                flat[row * stride + c0:row * stride + c1] = values
+        self.version += 1
+
+    def sync(self, walls):
+        """Catch up with walls, a WallIndex, by the walls built and destroyed since the last call."""
+        behind = walls.version - self.walls_version if self.walls_version is not None else None
+        if behind is None or behind > len(walls.changes):
+            self._rebuild(walls)
+        elif behind:
+            for wall, added in list(walls.changes)[-behind:]:
+                self._reweigh(*self._apply(wall, 1 if added else -1))
+        self.walls_version = walls.version
+        ring = self.outside > 0
+        if self.covered[0, 0] != ring:
+            self.covered[[0, -1], :] = ring
+            self.covered[:, [0, -1]] = ring
+
+    def rects(self, left, top, right, bottom):
+        """Rects touching a cell a wall covers, given as inclusive integer bounds (arrays).
+
+        Like WallCells.rects, but the cells are the grid's and finer. Rects
+        reaching outside the grid are left to beyond if there is one and
+        any wall reaches outside too, otherwise they only have the ring.
+        """
+        # Padded cells of the four bounds at once, everything outside the grid lands on its ring
+        cells = (np.array((left, right, top, bottom), dtype=np.int64) - self.origin) // self.cell_size + 1
+        c0, c1, r0, r1 = np.minimum(np.maximum(cells, 0), self.last)
+        covered = self.covered
+        # The corners are all there is to a rect up to two cells across, like
+        # a bullet's way in a frame; bigger ones go through every cell
+        found = covered[r0, c0] | covered[r0, c1] | covered[r1, c0] | covered[r1, c1]
+        span_x, span_y = c1 - c0, r1 - r0
+        if len(found) and (span_x.max() > 1 or span_y.max() > 1):
+            for ox in range(int(span_x.max()) + 1):
+                for oy in range(int(span_y.max()) + 1):
+                    found |= (ox <= span_x) & (oy <= span_y) & covered[np.minimum(r0 + oy, r1),
+                                                                       np.minimum(c0 + ox, c1)]
+        if self.outside and self.beyond is not None:
+            out = np.flatnonzero((c0 == 0) | (r0 == 0) | (c1 == self.width + 1) | (r1 == self.height + 1))
+            if len(out):
+                found[out] = self.beyond.rects(left[out], top[out], right[out], bottom[out])
+        return found
+
+    def cell(self, x, y):
+        """Flat index of the padded cell holding a point, or None outside the grid."""
+        col = math.floor((x - self.left) / self.cell_size)
+        row = math.floor((y - self.top) / self.cell_size)
+        if 0 <= col < self.width and 0 <= row < self.height:
+            return (row + 1) * (self.width + 2) + col + 1
+        return None
+
+
+class FlowField:
+    """Which way to go from every cell of the map to reach the nearest live player.
+
+    One Dijkstra run from the cells of all live players over a NavGrid
+    gives every cell its path distance to the nearest of them, and with
+    it the neighbouring cell to head for next. An enemy only looks up its
+    own cell, so the cost does not grow with the number of enemies. Map
+    walls cannot be crossed. Player walls can at a price: enemies go round
+    a short barricade and break through one that would be a long way round.
+    The players move all the time, so the whole field is searched again
+    every interval frames; walls only change the weights, and the grid
+    keeps those up to date around each wall. A search is skipped when
+    neither the grid nor the players' cells have changed since the last.
+
+    Outside the grid and where no path exists there is no direction.
+    """
+
+    def __init__(self, grid, interval=6):
+        self.grid = grid
+        self.interval = interval  # Ticks between recomputations
+        self.next_update = 0
+        self.step_x = self.step_y = None  # Step to the next cell, per cell, NaN where there is none
+        self.searched = None  # Grid version and player cells of the last search
+
+    def update(self, players, frame):
+        """Recompute from the live players every interval frames, the grid must be in sync."""
+        if frame < self.next_update:
+            return
+        self.next_update = frame + self.interval
+        sources = sorted({cell for cell in (self.grid.cell(p.x, p.y) for p in players) if cell is not None})
+        if not sources:
+            self.step_x = self.step_y = None
+            self.searched = None
+            return
+        searched = (self.grid.version, sources)
+        if searched != self.searched:
+            self._search(sources)
+            self.searched = searched
+
+    def _search(self, sources):
+        grid = self.grid
+        steps = grid.steps
+        dist = [math.inf] * ((grid.height + 2) * (grid.width + 2))
+        heap = []
+        for cell in sources:
+            dist[cell] = 0.0
+            heap.append((0.0, cell))
+        heapq.heapify(heap)
+        heappop, heappush = heapq.heappop, heapq.heappush
+        while heap:
+            d, cell = heappop(heap)
+            if d > dist[cell]:
+                continue
+            for offset, weight in steps:
+                nd = d + weight[cell]
+                neighbour = cell + offset
+                if nd < dist[neighbour]:
+                    dist[neighbour] = nd
+                    heappush(heap, (nd, neighbour))
+
+        # Next cell from each cell: the neighbour its shortest path goes through
+        h, w = grid.height, grid.width
+        dist = np.array(dist).reshape(h + 2, w + 2)
+        inner = (slice(1, h + 1), slice(1, w + 1))
+        through = np.stack([dist[1 + dy:h + 1 + dy, 1 + dx:w + 1 + dx] + weight[inner]
+                            for (dx, dy), weight in zip(STEPS, grid.weights)])
+        best = through.argmin(axis=0)
+        here = dist[inner]
+        # Players' own cells and unreachable ones have nowhere to go
+        found = (here > 0) & np.isfinite(here)
+        dx = np.array([s[0] for s in STEPS], dtype=float)[best]
+        dy = np.array([s[1] for s in STEPS], dtype=float)[best]
+        self.step_x = np.where(found, dx, np.nan).ravel()
+        self.step_y = np.where(found, dy, np.nan).ravel()
+
+    def direction(self, x, y):
+        """Way to go from each position (arrays) as dx, dy, and whether there is one.
+
+        A direction rather than a point to reach: an enemy wider than a cell
+        that is held up by a wall corner keeps sliding along the wall until
+        it is past it, instead of creeping up to the middle of the next cell.
+        """
+        if self.step_x is None:
+            return x, y, np.zeros(len(x), dtype=bool)
+        grid = self.grid
+        col = np.floor((x - grid.left) / grid.cell_size)
+        row = np.floor((y - grid.top) / grid.cell_size)
+        inside = (col >= 0) & (col < grid.width) & (row >= 0) & (row < grid.height)
+        cell = np.where(inside, row * grid.width + col, 0).astype(np.int64)
+        step_x, step_y = self.step_x[cell], self.step_y[cell]
+        return step_x, step_y, inside & ~np.isnan(step_x)
+
+
+def corner_nudge(position, size, low, high, move, step):
+    """Move along one axis that takes an enemy round a wall spanning low..high on it.
+
+    The wall blocks the enemy on the other axis. If either end of the wall
+    is less than size away, heads for the nearer one at most step far,
+    unless move already leads the other way; otherwise returns move.
+    """
+    before = position + size - low
+    after = high - (position - size)
+    if min(before, after) >= size:
+        return move
+    nudge = -min(before, step) if before < after else min(after, step)
+    return move if move * nudge < 0 else nudge
@@ -1,42 +1,279 @@
+import asyncio
 import json
+import math
 import socket
-import pickle
 import struct
 from common.game_objects import Player, Enemy, Bullet, Wall, LootBox, Mine, get_weapon_by_name, Pickup
+from common.codec import encode_message, decode_message, encode_snapshot, ProtocolError, SECTIONS, WALL_DAMAGE
+from common.udp import DatagramChannel, KIND_SNAPSHOT, MAX_DATAGRAM
+
+MAX_MESSAGE_SIZE = 1 << 20
+FRAME_LENGTH = struct.Struct('!I')
+
+
+def recv_exactly(sock, view):
+    """Fill view from sock; False if the connection closes first."""
+    while view:
+        n = sock.recv_into(view)
+        if not n:
+            return False
+        view = view[n:]
+    return True
+
 
 class NetworkProtocol:
     @staticmethod
     def create_message(message_type, data):
-        message = {
-            'type': message_type,
-            'data': data
-        }
-        return pickle.dumps(message)
+        return encode_message(message_type, data)
 
     @staticmethod
-    def send_message(sock, message):
+    def frame_message(message):
         message_data = NetworkProtocol.create_message(message['type'], message['data'])
-        message_length = len(message_data)
-        sock.sendall(struct.pack('!I', message_length))
-        sock.sendall(message_data)
+        return struct.pack('!I', len(message_data)) + message_data
+
+    @staticmethod
+    def send_message(sock, message):
+        sock.sendall(NetworkProtocol.frame_message(message))
 
     @staticmethod
     def receive_message(sock):
-        # Read message length
-        length_data = sock.recv(4)
-        if not length_data:
+        # Reads exactly one frame and nothing past it; long-lived connections
+        # keep a FrameReader instead
+        length_data = bytearray(4)
+        if not recv_exactly(sock, memoryview(length_data)):
             return None
         message_length = struct.unpack('!I', length_data)[0]
-        
-        # Read message data
-        message_data = b''
-        while len(message_data) < message_length:
-            chunk = sock.recv(min(message_length - len(message_data), 4096))
-            if not chunk:
+        if message_length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"Message of {message_length} bytes exceeds limit")
+        message_data = bytearray(message_length)
+        if not recv_exactly(sock, memoryview(message_data)):
+            return None
+        return decode_message(message_data)
+
+    @staticmethod
+    async def receive_message_async(reader):
+        try:
+            length_data = await reader.readexactly(4)
+            message_length = struct.unpack('!I', length_data)[0]
+            if message_length > MAX_MESSAGE_SIZE:
+                raise ProtocolError(f"Message of {message_length} bytes exceeds limit")
+            message_data = await reader.readexactly(message_length)
+        except asyncio.IncompleteReadError:
+            return None
+        return decode_message(message_data)
+
+class FrameReader:
+    """Length-prefixed frames from a stream socket, read into one reusable buffer.
+
+    recv_into fills a bytearray that only grows when a frame does not fit,
+    and frames are handed out as memoryviews into it, so there is no per-frame
+    allocation and no copying while a large snapshot trickles in. A view stays
+    valid until the next fill(); whoever keeps data longer must copy it (the
+    snapshot decoder and MapLayout.decode already do).
+    """
+
+    def __init__(self, sock, size=64 * 1024):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First byte not yet handed out
+        self.end = 0  # End of received data
+
+    def fill(self):
+        """One recv_into; returns the number of bytes read, 0 once the peer is gone."""
+        if self.start:
+            pending = self.end - self.start
+            # Only the tail of a partial frame moves, whole frames were consumed in place
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        if self.end == len(self.buffer):
+            self._grow(len(self.buffer) * 2)
+        n = self.sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def _grow(self, size):
+        buffer = bytearray(size)
+        buffer[:self.end] = self.buffer[:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+    def next_frame(self):
+        """Payload of the next complete buffered frame, or None."""
+        start = self.start
+        available = self.end - start
+        if available < 4:
+            return None  # The length header itself may arrive in pieces
+        message_length = FRAME_LENGTH.unpack_from(self.buffer, start)[0]
+        if message_length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"Message of {message_length} bytes exceeds limit")
+        if available < 4 + message_length:
+            if 4 + message_length > len(self.buffer):
+                # Make room now so the rest of the frame is read straight into place
+                self.buffer[:available] = self.buffer[start:self.end]
+                self.start, self.end = 0, available
+                self._grow(max(4 + message_length, len(self.buffer) * 2))
+            return None
+        start += 4
+        self.start = start + message_length
+        return self.view[start:self.start]
+
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def read_frame(self):
+        """Block until a whole frame is buffered; None when the connection closes."""
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if not self.fill():
                 return None
-            message_data += chunk
-        
-        return pickle.loads(message_data)
+
+    def receive_message(self):
+        frame = self.read_frame()
+        if frame is None:
+            return None
+        return decode_message(frame)
+
+
+class SnapshotFrames:
+    """Ready-to-send frames of one snapshot, shared by every client.
+
+    A frame is encoded the first time some client needs it and then reused
+    for every other client acking the same baseline, so a tick costs one
+    encode per distinct baseline instead of one per client. Frames are
+    immutable bytes handed to each connection as is.
+    """
+
+    def __init__(self, snapshot, history):
+        self.snapshot = snapshot
+        self.history = history
+        self.payloads = {}
+        self.frames = {}
+        self.datagrams = {}
+
+    def payload_for(self, baseline_tick):
+        baseline = self.history.get(baseline_tick)
+        key = baseline.tick if baseline is not None else 0
+        payload = self.payloads.get(key)
+        if payload is None:
+            payload = encode_snapshot(self.snapshot, baseline)
+            self.payloads[key] = payload
+        return key, payload
+
+    def frame_for(self, baseline_tick):
+        key, payload = self.payload_for(baseline_tick)
+        frame = self.frames.get(key)
+        if frame is None:
+            frame = NetworkProtocol.frame_message({'type': 'game_state', 'data': payload})
+            self.frames[key] = frame
+        return frame
+
+    def datagram_for(self, baseline_tick):
+        """Snapshot datagram sequenced by tick, or None if it would not fit one."""
+        key, payload = self.payload_for(baseline_tick)
+        if key not in self.datagrams:
+            datagram = DatagramChannel.pack(KIND_SNAPSHOT, self.snapshot.tick, payload)
+            self.datagrams[key] = datagram if len(datagram) <= MAX_DATAGRAM else None
+        return self.datagrams[key]
+
+
+# In-place snapshot application: how to create an entity the first time
+# it shows up and how to refresh it from a decoded record afterwards.
+def _new_player(entity_id, data):
+    return Player(data['x'], data['y'], entity_id)
+
+
+def _update_player(player, data):
+    player.x = data['x']
+    player.y = data['y']
+    player.angle = data['angle']
+    player.health = data['health']
+    player.armor = data['armor']
+    player.weapons = [get_weapon_by_name(name) for name in data['weapons']]
+    player.selected_weapon_index = data['selected_weapon_index']
+    player.dead = data['dead']
+    player.respawn_timer = data['respawn_timer']
+    player.input_seq = data['input_seq']
+    player.ammo = data['ammo']
+
+
+def _new_enemy(entity_id, data):
+    return Enemy(data['x'], data['y'], data['type'])
+
+
+def _update_enemy(enemy, data):
+    enemy.x = data['x']
+    enemy.y = data['y']
+    enemy.health = data['health']
+    enemy.look_angle = data['look_angle']
+
+
+def _new_bullet(entity_id, data):
+    return Bullet(data['origin_x'], data['origin_y'], data['angle'], data['player_id'])
+
+
+def _update_bullet(bullet, data):
+    # Bullet records never change; the position follows the snapshot frame in apply_snapshot
+    bullet.origin_x, bullet.origin_y = data['origin_x'], data['origin_y']
+    bullet.speed = data['speed']
+    bullet.spawn_frame = data['spawn_frame']
+    bullet.color = data['color']
+
+
+def _new_lootbox(entity_id, data):
+    return LootBox(data['x'], data['y'], get_weapon_by_name(data['weapon']))
+
+
+def _update_lootbox(lootbox, data):
+    lootbox.x = data['x']
+    lootbox.y = data['y']
+
+
+def _new_mine(entity_id, data):
+    return Mine(data['x'], data['y'], data['owner_id'], data['damage'])
+
+
+def _update_mine(mine, data):
+    mine.x = data['x']
+    mine.y = data['y']
+    mine.active = data['active']
+
+
+def _new_pickup(entity_id, data):
+    return Pickup(data['x'], data['y'], data['pickup_type'], data['value'])
+
+
+def _update_pickup(pickup, data):
+    pickup.x = data['x']
+    pickup.y = data['y']
+    pickup.value = data['value']
+
+
+def _new_wall(entity_id, data):
+    return Wall(data['x'], data['y'], data['width'], data['height'], data['is_player_wall'], data['health'])
+
+
+def _update_wall(wall, data):
+    wall.rect.update(data['x'], data['y'], data['width'], data['height'])
+    wall.health = data['health']
+
+
+_ENTITY_APPLY = {
+    'players': (_new_player, _update_player),
+    'enemies': (_new_enemy, _update_enemy),
+    'bullets': (_new_bullet, _update_bullet),
+    'lootboxes': (_new_lootbox, _update_lootbox),
+    'mines': (_new_mine, _update_mine),
+    'pickups': (_new_pickup, _update_pickup),
+    'walls': (_new_wall, _update_wall),
+}
+
 
 class GameState:
     def __init__(self):
@@ -51,6 +288,87 @@ class GameState:
         self.wave = 1
         self.wave_cooldown = 0
         self.scores = {}
+        self.frame = 0  # Simulation tick counter
+        self.map_layout = None  # Static walls, see common.maps
+        # apply_snapshot bookkeeping: last applied record bytes and live objects per section
+        self._records = {}
+        self._objects = {}
+        self._positions = {}  # (section, id) -> snapshot x, y, angle of players and enemies
+        self._wall_damage = {}
+
+    def apply_snapshot(self, snapshot, map_layout=None):
+        """Bring this state up to date with a decoded Snapshot, in place.
+
+        Entities stay the same objects for as long as they exist. A record
+        whose bytes match the last applied one is not decoded at all, objects
+        are created and dropped only as entities appear and disappear, and
+        the entity lists are rebuilt only when that happens.
+        """
+        self.frame = snapshot.frame
+        self.game_over = snapshot.game_over
+        self.wave = snapshot.wave
+        self.wave_cooldown = snapshot.wave_cooldown
+        self.scores = dict(snapshot.scores)
+        rebuild_walls = map_layout is not self.map_layout
+        self.map_layout = map_layout
+        positions = self._positions
+
+        for section in SECTIONS:
+            key = section.key
+            records = snapshot.sections[key]
+            applied = self._records.setdefault(key, {})
+            if key == 'wall_damage':
+                if records != applied:
+                    self._records[key] = dict(records)
+                    self._wall_damage = {i: WALL_DAMAGE.unpack_from(r, 0)['health'] for i, r in records.items()}
+                    rebuild_walls = True
+                continue
+            objects = self._objects.setdefault(key, {})
+            new, update = _ENTITY_APPLY[key]
+            changed = False
+            for entity_id in [i for i in applied if i not in records]:
+                del applied[entity_id]
+                del objects[entity_id]
+                positions.pop((key, entity_id), None)
+                changed = True
+            for entity_id, record_bytes in records.items():
+                if applied.get(entity_id) == record_bytes:
+                    continue
+                data = section.decode(record_bytes, snapshot)
+                obj = objects.get(entity_id)
+                if obj is None:
+                    obj = new(entity_id, data)
+                    obj.entity_id = entity_id
+                    objects[entity_id] = obj
+                    changed = True
+                update(obj, data)
+                applied[entity_id] = record_bytes
+                if key in ('players', 'enemies'):
+                    positions[key, entity_id] = (data['x'], data['y'], data.get('angle', data.get('look_angle')))
+            if key == 'players':
+                self.players = objects
+            elif changed:
+                if key == 'walls':
+                    rebuild_walls = True
+                else:
+                    setattr(self, key, list(objects.values()))
+
+        # Interpolation and prediction move players and enemies between
+        # snapshots, put the snapshot values back on the ones not decoded again
+        for pid, p in self.players.items():
+            p.x, p.y, p.angle = positions['players', pid]
+        for e in self.enemies:
+            e.x, e.y, e.look_angle = positions['enemies', e.entity_id]
+        for b in self.bullets:
+            b.age = snapshot.frame - b.spawn_frame
+            rad = math.radians(b.angle)
+            b.x = b.origin_x + math.cos(rad) * b.speed * b.age
+            b.y = b.origin_y + math.sin(rad) * b.speed * b.age
+
+        if rebuild_walls:
+            # Static walls come from the map handshake, snapshots only carry their damage
+            walls = map_layout.apply_damage(self._wall_damage) if map_layout is not None else []
+            self.walls = walls + list(self._objects['walls'].values())
 
     def to_dict(self):
         return {
@@ -79,7 +397,7 @@ class GameState:
         }
 
     @classmethod
-    def from_dict(cls, data):
+    def from_dict(cls, data, map_layout=None):
         from common.game_objects import Player, Enemy, Bullet, LootBox, Mine, get_weapon_by_name, Wall, Pickup
         state = cls()
 
@@ -92,36 +410,114 @@ class GameState:
             player.selected_weapon_index = p_data.get('selected_weapon_index', 0)
             player.dead = p_data.get('dead', False)
             player.respawn_timer = p_data.get('respawn_timer', 0)
+            player.input_seq = p_data.get('input_seq', 0)  # Last of its inputs the server has applied
             player.ammo = {}
             for weapon_name, ammo_count in p_data.get('ammo', {}).items():
                 player.ammo[weapon_name] = ammo_count
             state.players[pid] = player
         for e_data in data['enemies']:
             enemy = Enemy(e_data['x'], e_data['y'], e_data.get('type', 1))
+            enemy.entity_id = e_data.get('id', 0)
             enemy.health = e_data['health']
             enemy.look_angle = e_data.get('look_angle', 0)
             state.enemies.append(enemy)
         for b_data in data['bullets']:
             bullet = Bullet(b_data['x'], b_data['y'], b_data['angle'], b_data['player_id'])
+            bullet.entity_id = b_data.get('id', 0)
+            if 'spawn_frame' in b_data:
+                bullet.origin_x, bullet.origin_y = b_data['origin_x'], b_data['origin_y']
+                bullet.speed = b_data['speed']
+                bullet.age = data.get('frame', 0) - b_data['spawn_frame']
             if 'color' in b_data:
                 bullet.color = b_data['color']
             state.bullets.append(bullet)
         for l_data in data.get('lootboxes', []):
             weapon = get_weapon_by_name(l_data['weapon'])
             lootbox = LootBox(l_data['x'], l_data['y'], weapon)
+            lootbox.entity_id = l_data.get('id', 0)
             state.lootboxes.append(lootbox)
         for m_data in data.get('mines', []):
             mine = Mine(m_data['x'], m_data['y'], m_data['owner_id'], m_data['damage'])
+            mine.entity_id = m_data.get('id', 0)
             mine.active = m_data.get('active', True)
             state.mines.append(mine)
+        if map_layout is not None:
+            # Static walls are built once from the map handshake, snapshots only carry their damage
+            state.map_layout = map_layout
+            state.walls = map_layout.apply_damage({d['id']: d['health'] for d in data.get('wall_damage', [])})
         for w_data in data.get('walls', []):
             wall = Wall(w_data['x'], w_data['y'], w_data['width'], w_data['height'], w_data.get('is_player_wall', False), w_data.get('health', 100))
+            wall.entity_id = w_data.get('id', 0)
             state.walls.append(wall)
         for p_data in data.get('pickups', []):
             pickup = Pickup(p_data['x'], p_data['y'], p_data['pickup_type'], p_data['value'])
+            pickup.entity_id = p_data.get('id', 0)
             state.pickups.append(pickup)
         state.game_over = data.get('game_over', False)
         state.wave = data.get('wave', 1)
         state.wave_cooldown = data.get('wave_cooldown', 0)
         state.scores = data.get('scores', {})
-        return state 
\ No newline at end of file
+        state.frame = data.get('frame', 0)
+        return state 
+
+def apply_benchmark(ticks=300, enemies=60, bullets=150, seed=1):
+    """Compare rebuilding a GameState per snapshot with apply_snapshot.
+
+    Run with `python -m common.network`. Replays the same stream of
+    snapshots, with moving enemies and a steady stream of bullets, through
+    both client paths and reports time per snapshot and objects created.
+    """
+    import itertools
+    import random
+    import time
+    from common.codec import Snapshot, SnapshotDecoder
+    from common.registry import IdAllocator
+
+    rng = random.Random(seed)
+    ids = IdAllocator()
+
+    def spawn(entity):
+        entity.entity_id = ids.allocate()
+        return entity
+
+    state = GameState()
+    for pid in range(3):
+        state.players[pid] = Player(100 + 50 * pid, 100, pid)
+    state.enemies = [spawn(Enemy(rng.randint(50, 750), rng.randint(50, 550), rng.randint(1, 4))) for _ in range(enemies)]
+    state.bullets = [spawn(Bullet(400, 300, rng.uniform(0, 360), 0)) for _ in range(bullets)]
+    state.lootboxes = [spawn(LootBox(rng.randint(50, 750), rng.randint(50, 550))) for _ in range(10)]
+    state.walls = [spawn(Wall(200 + 40 * i, 200, 40, 40, True)) for i in range(5)]
+
+    decoder = SnapshotDecoder()
+    snapshots = []
+    for tick in range(1, ticks + 1):
+        for _ in range(2):  # Two simulation frames per snapshot, as at 60 Hz ticks and 30 Hz sends
+            state.frame += 1
+            for b in state.bullets:
+                b.update()
+        for e in state.enemies[::3]:  # A third of the horde is on the move
+            e.x += 1
+        ids.release(state.bullets.pop(0).entity_id)
+        state.bullets.append(spawn(Bullet(400, 300, rng.uniform(0, 360), 0)))
+        snapshots.append(decoder.decode(encode_snapshot(Snapshot.from_state(state, tick))))
+
+    def measure(apply):
+        elapsed = 0.0
+        seen = {}  # An entity object not met in an earlier state was created for this one
+        for snapshot in snapshots:
+            start = time.perf_counter()
+            state = apply(snapshot)
+            elapsed += time.perf_counter() - start
+            for entity in itertools.chain(state.enemies, state.bullets, state.lootboxes, state.walls):
+                seen.setdefault(id(entity), entity)
+        return elapsed / len(snapshots) * 1e6, len(seen) / len(snapshots)
+
+    rebuild = measure(lambda snapshot: GameState.from_dict(snapshot.to_dict()))
+    live = GameState()
+    in_place = measure(lambda snapshot: live.apply_snapshot(snapshot) or live)
+    print(f"{enemies} enemies, {bullets} bullets, {ticks} snapshots")
+    print(f"rebuild (from_dict):       {rebuild[0]:8.1f} us/snapshot, {rebuild[1]:6.1f} entities created/snapshot")
+    print(f"in place (apply_snapshot): {in_place[0]:8.1f} us/snapshot, {in_place[1]:6.1f} entities created/snapshot")
+
+if __name__ == '__main__':
+    apply_benchmark()
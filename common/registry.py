@@ -0,0 +1,92 @@
+import collections
+
+# Entity ids are 32-bit like ENTITY_ID in the snapshot codec: the low bits
+# pick a slot, the high bits count how many times that slot was reused, so
+# an id that refers to a dead entity never matches its replacement.
+SLOT_BITS = 20
+SLOT_MASK = (1 << SLOT_BITS) - 1
+GENERATION_MASK = (1 << (32 - SLOT_BITS)) - 1
+
+
+class IdAllocator:
+    """Generational integer ids with slot reuse."""
+
+    def __init__(self):
+        self.generations = []
+        self.free = collections.deque()  # Oldest freed slot is reused first
+
+    def allocate(self):
+        if self.free:
+            slot = self.free.popleft()
+        else:
+            slot = len(self.generations)
+            if slot > SLOT_MASK:
+                raise RuntimeError("Out of entity slots")
+            self.generations.append(1)  # Generation 0 is never used, so no id is 0
+        return (self.generations[slot] << SLOT_BITS) | slot
+
+    def release(self, entity_id):
+        slot = entity_id & SLOT_MASK
+        self.generations[slot] = self.generations[slot] % GENERATION_MASK + 1
+        self.free.append(slot)
+
+
+class EntityRegistry:
+    """Live entities of one kind in a dense list, with ids from an IdAllocator.
+
+    add() stamps the entity with a fresh entity_id. discard() takes it out
+    at once for `in`, get() and len(), but it stays in place, so iteration
+    still meets it, until compact() swaps the last entities into the holes
+    in one go. Removal is O(1) and the order of entities is not kept.
+    """
+
+    def __init__(self, allocator=None):
+        self.entities = []
+        self.index = {}  # entity_id -> position in entities
+        self.ids = allocator if allocator is not None else IdAllocator()
+        self.discarded = []  # Positions of discarded entities still in entities
+
+    def add(self, entity):
+        entity.entity_id = self.ids.allocate()
+        self.index[entity.entity_id] = len(self.entities)
+        self.entities.append(entity)
+        return entity
+
+    def get(self, entity_id):
+        i = self.index.get(entity_id)
+        return self.entities[i] if i is not None else None
+
+    def discard(self, entity):
+        """Mark the entity as gone, it leaves entities at the next compact()."""
+        self.discarded.append(self.index.pop(entity.entity_id))
+        self.ids.release(entity.entity_id)
+
+    def compact(self):
+        entities, index = self.entities, self.index
+        # From the back, so the last entity is never one still to be dropped
+        for i in sorted(self.discarded, reverse=True):
+            last = entities.pop()
+            if i < len(entities):
+                entities[i] = last
+                index[last.entity_id] = i
+        self.discarded = []
+
+    def clear(self):
+        for entity_id in self.index:
+            self.ids.release(entity_id)
+        self.entities = []
+        self.index = {}
+        self.discarded = []
+
+    def __contains__(self, entity):
+        i = self.index.get(getattr(entity, 'entity_id', None))
+        return i is not None and self.entities[i] is entity
+
+    def __getitem__(self, key):
+        return self.entities[key]
+
+    def __iter__(self):
+        return iter(self.entities)
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,301 @@
+import collections
+import functools
+import itertools
+import math
+
+
+class UniformGrid:
+    """Points bucketed into square cells for cheap rectangle queries.
+
+    Rebuilt from scratch whenever the points move, which for a few hundred
+    entities is cheaper than tracking them incrementally.
+    """
+
+    def __init__(self, cell_size=200):
+        self.cell_size = cell_size
+        self.cells = collections.defaultdict(list)
+        self.positions = {}
+
+    def insert(self, key, x, y):
+        self.positions[key] = (x, y)
+        self.cells[(int(x // self.cell_size), int(y // self.cell_size))].append(key)
+
+    def query_rect(self, x0, y0, x1, y1):
+        cs = self.cell_size
+        cells = self.cells
+        positions = self.positions
+        for cx in range(int(x0 // cs), int(x1 // cs) + 1):
+            for cy in range(int(y0 // cs), int(y1 // cs) + 1):
+                for key in cells.get((cx, cy), ()):
+                    x, y = positions[key]
+                    if x0 <= x <= x1 and y0 <= y <= y1:
+                        yield key
+
+
+@functools.lru_cache(maxsize=None)
+def squared_radius(radius):
+    """Threshold for squared distances that matches `distance ** 0.5 < radius` exactly.
+
+    Usually radius * radius, but the root rounds, so a few squared
+    distances just below it have a root equal to radius and must not count
+    as inside. Tested with ** 0.5 itself: on a tie it can round the other
+    way from math.sqrt, as it does just below 0.25 and 1.
+    """
+    d = float(radius) * radius
+    while d > 0 and math.nextafter(d, 0) ** 0.5 >= radius:
+        d = math.nextafter(d, 0)
+    return d
+
+
+def segment_entry(rect, x0, y0, dx, dy):
+    """Fraction of the way from (x0, y0) by (dx, dy) at which the segment enters rect, or None.
+
+    0 if it starts inside. Inside means what collidepoint means, the
+    right and bottom edges are not part of the rect, so on each axis the
+    fractions inside are an interval open at one end.
+    """
+    enter, enter_open, leave, leave_open = 0.0, False, 1.0, False
+    for start, d, low, high in ((x0, dx, rect.left, rect.right), (y0, dy, rect.top, rect.bottom)):
+        if d > 0:
+            first, first_open, last, last_open = (low - start) / d, False, (high - start) / d, True
+        elif d < 0:
+            first, first_open, last, last_open = (high - start) / d, True, (low - start) / d, False
+        elif low <= start < high:
+            continue
+        else:
+            return None
+        if first > enter or (first == enter and first_open):
+            enter, enter_open = first, first_open
+        if last < leave or (last == leave and last_open):
+            leave, leave_open = last, last_open
+    if enter < leave or (enter == leave and not enter_open and not leave_open):
+        return enter
+    return None
+
+
+class WallGrid:
+    """Walls bucketed into every cell their rect overlaps.
+
+    Each cell keeps its walls in the order they were added, so the first
+    hit in a cell is the wall a scan of the wall list would have found.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        # Cells created (True) or emptied (False) lately, one entry per
+        # version, so indexes built on top can catch up without a rebuild
+        self.version = 0
+        self.changes = collections.deque(maxlen=256)
+
+    def _keys(self, rect):
+        cs = self.cell_size
+        for cx in range(rect.x // cs, (rect.right - 1) // cs + 1):
+            for cy in range(rect.y // cs, (rect.bottom - 1) // cs + 1):
+                yield cx, cy
+
+    def add(self, wall):
+        for key in self._keys(wall.rect):
+            cell = self.cells.get(key)
+            if cell is None:
+                cell = self.cells[key] = []
+                self.version += 1
+                self.changes.append((key, True))
+            cell.append(wall)
+
+    def remove(self, wall):
+        for key in self._keys(wall.rect):
+            cell = self.cells[key]
+            cell.remove(wall)
+            if not cell:
+                del self.cells[key]
+                self.version += 1
+                self.changes.append((key, False))
+
+    def collide_rect(self, rect, order):
+        cs = self.cell_size
+        cells = self.cells
+        best = None
+        for cx in range(rect.x // cs, (rect.right - 1) // cs + 1):
+            for cy in range(rect.y // cs, (rect.bottom - 1) // cs + 1):
+                for wall in cells.get((cx, cy), ()):
+                    if wall.rect.colliderect(rect):
+                        if best is None or order[wall] < order[best]:
+                            best = wall
+                        break
+        return best
+
+    def _entered(self, key, x0, y0, dx, dy, box, order, best):
+        # best, or the wall of cell key the segment enters first if that is earlier
+        for wall in self.cells.get(key, ()):
+            if wall.rect.colliderect(box):
+                t = segment_entry(wall.rect, x0, y0, dx, dy)
+                if t is not None and (best is None or (t, order[wall]) < (best[0], order[best[1]])):
+                    best = (t, wall)
+        return best
+
+    def raycast(self, x0, y0, x1, y1, box, order):
+        """(t, wall) for the first wall the segment runs into, t its fraction of the way, or None.
+
+        Walks the cells the segment crosses in order (a DDA): a wall entered
+        within the current cell cannot be beaten by one in a later cell.
+        Walls off box, a rect holding the segment, are skipped untested.
+        """
+        cs = self.cell_size
+        dx, dy = x1 - x0, y1 - y0
+        cx, cy = math.floor(x0 / cs), math.floor(y0 / cs)
+        # Steps left on each axis, so rounding can never walk past the last cell
+        left_x = math.floor(x1 / cs) - cx
+        left_y = math.floor(y1 / cs) - cy
+        if not left_x and not left_y:
+            # Most bullets stay in one cell in a frame
+            return self._entered((cx, cy), x0, y0, dx, dy, box, order, None)
+        step_x, step_y = (1 if left_x > 0 else -1), (1 if left_y > 0 else -1)
+        left_x, left_y = abs(left_x), abs(left_y)
+        # t at which the segment crosses the next cell border on each axis, and per cell
+        next_x = ((cx + (step_x > 0)) * cs - x0) / dx if left_x else math.inf
+        next_y = ((cy + (step_y > 0)) * cs - y0) / dy if left_y else math.inf
+        delta_x = cs / abs(dx) if left_x else math.inf
+        delta_y = cs / abs(dy) if left_y else math.inf
+        best = None
+        while True:
+            best = self._entered((cx, cy), x0, y0, dx, dy, box, order, best)
+            if not left_x and not left_y:
+                return best
+            if left_x and (not left_y or next_x < next_y):
+                leave = next_x
+                cx += step_x
+                next_x += delta_x
+                left_x -= 1
+            else:
+                leave = next_y
+                cy += step_y
+                next_y += delta_y
+                left_y -= 1
+            if best is not None and best[0] < leave:
+                return best
+
+
+class WallIndex:
+    """Spatial hash of the walls, kept in step with the wall list.
+
+    Map walls are few and long and live in a coarse static grid. Player
+    walls are small and come and go all game, they get a finer grid of
+    their own. Both are updated one wall at a time as walls are built and
+    destroyed. Queries return the first colliding wall in wall list order,
+    like the linear scans they replace.
+    """
+
+    def __init__(self, walls=(), static_cell_size=128, dynamic_cell_size=64):
+        self.static = WallGrid(static_cell_size)
+        self.dynamic = WallGrid(dynamic_cell_size)
+        self.order = {}  # wall -> position it was added at
+        self.added = itertools.count()
+        # Walls added (True) or removed (False) lately, one entry per version,
+        # for structures derived from the walls to catch up without a rebuild
+        self.version = 0
+        self.changes = collections.deque(maxlen=256)
+        for wall in walls:
+            self.add(wall)
+
+    def add(self, wall):
+        self.order[wall] = next(self.added)
+        self.version += 1
+        self.changes.append((wall, True))
+        (self.dynamic if wall.is_player_wall else self.static).add(wall)
+
+    def remove(self, wall):
+        del self.order[wall]
+        self.version += 1
+        self.changes.append((wall, False))
+        (self.dynamic if wall.is_player_wall else self.static).remove(wall)
+
+    def __contains__(self, wall):
+        return wall in self.order
+
+    def __len__(self):
+        return len(self.order)
+
+    def collide_rect(self, rect):
+        """First wall overlapping rect, or None."""
+        order = self.order
+        hit = self.static.collide_rect(rect, order)
+        if not self.dynamic.cells:
+            return hit
+        other = self.dynamic.collide_rect(rect, order)
+        if hit is None or (other is not None and order[other] < order[hit]):
+            return other
+        return hit
+
+    def raycast(self, x0, y0, x1, y1):
+        """First wall the segment from (x0, y0) to (x1, y1) runs into, as (wall, x, y), or None.
+
+        x, y is where the segment enters the wall, the start if it is inside
+        already. Of walls entered at the same point the first in wall list
+        order wins, as in the other queries.
+        """
+        order = self.order
+        left, right = (math.floor(x0), math.floor(x1)) if x0 < x1 else (math.floor(x1), math.floor(x0))
+        top, bottom = (math.floor(y0), math.floor(y1)) if y0 < y1 else (math.floor(y1), math.floor(y0))
+        box = (left, top, right - left + 1, bottom - top + 1)
+        hit = self.static.raycast(x0, y0, x1, y1, box, order)
+        other = self.dynamic.raycast(x0, y0, x1, y1, box, order) if self.dynamic.cells else None
+        if hit is None or (other is not None and (other[0], order[other[1]]) < (hit[0], order[hit[1]])):
+            hit = other
+        if hit is None:
+            return None
+        t, wall = hit
+        return wall, x0 + (x1 - x0) * t, y0 + (y1 - y0) * t
+
+
+class LineOfSight:
+    """Whether any wall stands between two points, cached per pair of cells.
+
+    The line is drawn between the centres of the cells the points are in,
+    so everyone in the same two cells shares one raycast. Answers stay
+    cached until a wall the line runs into is built or destroyed, found
+    from the wall index's change log; if it has moved on further than the
+    log goes back, everything is forgotten.
+    """
+
+    def __init__(self, walls, cell_size=20, max_size=4096):
+        self.walls = walls
+        self.cell_size = cell_size
+        self.max_size = max_size
+        self.cache = {}  # (col, row, col, row) -> clear
+        self.version = walls.version
+
+    def _line(self, key):
+        cs = self.cell_size
+        c0, r0, c1, r1 = key
+        return (c0 + 0.5) * cs, (r0 + 0.5) * cs, (c1 - c0) * cs, (r1 - r0) * cs
+
+    def _sync(self):
+        walls = self.walls
+        behind = walls.version - self.version
+        self.version = walls.version
+        if behind > len(walls.changes):
+            self.cache.clear()
+            return
+        cache = self.cache
+        for wall, added in itertools.islice(walls.changes, len(walls.changes) - behind, None):
+            # A new wall can only block clear lines, a removed one only open blocked ones
+            rect = wall.rect
+            stale = [key for key, clear in cache.items()
+                     if clear == added and segment_entry(rect, *self._line(key)) is not None]
+            for key in stale:
+                del cache[key]
+
+    def clear(self, x0, y0, x1, y1):
+        """True if no wall blocks the line from (x0, y0) to (x1, y1)."""
+        if self.version != self.walls.version:
+            self._sync()
+        cs = self.cell_size
+        key = (math.floor(x0 / cs), math.floor(y0 / cs), math.floor(x1 / cs), math.floor(y1 / cs))
+        clear = self.cache.get(key)
+        if clear is None:
+            if len(self.cache) >= self.max_size:
+                self.cache.clear()
+            sx, sy, dx, dy = self._line(key)
+            clear = self.cache[key] = self.walls.raycast(sx, sy, sx + dx, sy + dy) is None
+        return clear
@@ -0,0 +1,27 @@
+import collections
+import math
+
+
+class FrameTimes:
+    """Rolling window of frame durations in milliseconds."""
+
+    def __init__(self, window=600):
+        self.times = collections.deque(maxlen=window)
+
+    def add(self, ms):
+        self.times.append(ms)
+
+    def summary(self):
+        if not self.times:
+            return {}
+        times = sorted(self.times)
+        n = len(times)
+        mean = sum(times) / n
+        return {
+            'frames': n,
+            'mean_ms': round(mean, 2),
+            'p50_ms': times[n // 2],
+            'p99_ms': times[min(n - 1, int(n * 0.99))],
+            'max_ms': times[-1],
+            'jitter_ms': round(math.sqrt(sum((t - mean) ** 2 for t in times) / n), 2),  # Standard deviation
+        }
@@ -0,0 +1,69 @@
+import collections
+import time
+from common.stats import FrameTimes
+
+
+class FixedTimestep:
+    """Calls a step function rate times per second of real time.
+
+    Elapsed time on the monotonic clock goes into an accumulator and a
+    step is taken for every 1/rate seconds of it, so a slow tick or a late
+    wakeup is made up with extra steps instead of slowing the game down,
+    and sleep errors never add up. After a stall at most max_steps run
+    back to back and the rest of the backlog is dropped: an overloaded
+    server runs slow instead of falling further and further behind.
+    """
+
+    def __init__(self, rate, max_steps=5, clock=time.perf_counter):
+        self.rate = rate
+        self.step = 1 / rate
+        self.max_steps = max_steps
+        self.clock = clock
+        self.accumulator = self.step  # The first step is due at once
+        self.last = None
+        self.tick_times = FrameTimes()
+        self.starts = collections.deque(maxlen=2 * rate)  # Start of recent steps, for the achieved rate
+        self.overruns = 0  # Steps that took longer than 1/rate
+        self.dropped = 0  # Steps given up after stalls
+
+    def due(self):
+        """Number of steps to take now."""
+        now = self.clock()
+        if self.last is not None:
+            self.accumulator += now - self.last
+        self.last = now
+        steps = int(self.accumulator // self.step)
+        if steps > self.max_steps:
+            self.dropped += steps - self.max_steps
+            self.accumulator -= (steps - self.max_steps) * self.step
+            steps = self.max_steps
+        self.accumulator -= steps * self.step
+        return steps
+
+    def run(self, step):
+        """Take the steps that are due, timing each of them."""
+        for _ in range(self.due()):
+            start = self.clock()
+            step()
+            elapsed = self.clock() - start
+            self.starts.append(start)
+            self.tick_times.add(round(elapsed * 1000, 2))
+            if elapsed > self.step:
+                self.overruns += 1
+
+    def delay(self):
+        """Seconds until the next step is due."""
+        if self.last is None:
+            return 0.0
+        return max(0.0, self.step - self.accumulator - (self.clock() - self.last))
+
+    def achieved_rate(self):
+        if len(self.starts) < 2 or self.starts[-1] == self.starts[0]:
+            return 0.0
+        return (len(self.starts) - 1) / (self.starts[-1] - self.starts[0])
+
+    def stats(self):
+        summary = self.tick_times.summary()
+        summary.update(target_hz=self.rate, achieved_hz=round(self.achieved_rate(), 1),
+                       overruns=self.overruns, dropped_steps=self.dropped)
+        return summary
@@ -0,0 +1,148 @@
+import collections
+import random
+import socket
+import struct
+from common.codec import PLAYER_INPUT, ProtocolError, pack_input
+
+# Optional datagram transport for the two high-rate streams: snapshots
+# (server -> client) and inputs (client -> server). Everything that must
+# arrive - map handshake, weapon switches, restarts - stays on TCP.
+#
+# Every datagram starts with PACKET_HEADER. The sequence number is the
+# snapshot tick for snapshots and the newest input sequence for inputs, so
+# a receiver can drop anything older than what it already has.
+PROTOCOL_ID = 0xB0C5
+PACKET_HEADER = struct.Struct('!HBI')  # protocol id, kind, sequence
+KIND_HELLO = 1  # client -> server, payload: token from the udp_info message
+KIND_SNAPSHOT = 2  # server -> client, payload: encode_snapshot output
+KIND_INPUT = 3  # client -> server, payload: INPUT_HEADER + recent inputs
+
+INPUT_HEADER = struct.Struct('!IB')  # acked snapshot tick, input count
+INPUT_REDUNDANCY = 4  # Inputs repeated in every packet, covers up to 3 lost packets in a row
+MAX_DATAGRAM = 1400  # Stay under a typical MTU; bigger snapshots go over TCP
+
+
+class DatagramChannel:
+    """Sequencing for one direction of a datagram stream: newest wins."""
+
+    def __init__(self):
+        self.last_seq = None
+        self.received = 0
+        self.stale = 0
+        self.lost = 0
+
+    @staticmethod
+    def pack(kind, seq, payload=b''):
+        return PACKET_HEADER.pack(PROTOCOL_ID, kind, seq) + payload
+
+    @staticmethod
+    def unpack(data):
+        if len(data) < PACKET_HEADER.size:
+            raise ProtocolError("Datagram too short")
+        protocol_id, kind, seq = PACKET_HEADER.unpack_from(data, 0)
+        if protocol_id != PROTOCOL_ID:
+            raise ProtocolError("Not a game datagram")
+        return kind, seq, memoryview(data)[PACKET_HEADER.size:]
+
+    def accept(self, seq):
+        """True if seq is newer than anything seen so far on this channel."""
+        if self.last_seq is not None and seq <= self.last_seq:
+            self.stale += 1
+            return False
+        if self.last_seq is not None:
+            self.lost += seq - self.last_seq - 1
+        self.last_seq = seq
+        self.received += 1
+        return True
+
+
+class InputHistory:
+    """Client side: the last few inputs, resent in every input datagram."""
+
+    def __init__(self, size=INPUT_REDUNDANCY):
+        self.inputs = collections.deque(maxlen=size)
+
+    def add(self, data):
+        self.inputs.append(data)
+
+    def packet(self, ack_tick):
+        parts = [INPUT_HEADER.pack(ack_tick, len(self.inputs))]
+        parts.extend(pack_input(data) for data in self.inputs)
+        return DatagramChannel.pack(KIND_INPUT, self.inputs[-1]['seq'] if self.inputs else 0, b''.join(parts))
+
+
+def unpack_inputs(payload):
+    """Return (acked snapshot tick, inputs oldest first) from an input datagram."""
+    if len(payload) < INPUT_HEADER.size:
+        raise ProtocolError("Malformed input datagram")
+    ack_tick, count = INPUT_HEADER.unpack_from(payload, 0)
+    if len(payload) != INPUT_HEADER.size + count * PLAYER_INPUT.size:
+        raise ProtocolError("Malformed input datagram")
+    inputs = []
+    for i in range(count):
+        inputs.append(PLAYER_INPUT.unpack_from(payload, INPUT_HEADER.size + i * PLAYER_INPUT.size))
+    return ack_tick, inputs
+
+
+def loopback_demo(packets=2000, loss=0.2, reorder=0.1, seed=1):
+    """Push snapshots and inputs through a lossy, reordering loopback link.
+
+    Run with `python -m common.udp`. Shows that snapshots never go
+    backwards and that redundant inputs recover almost every lost input.
+    """
+    rng = random.Random(seed)
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    client.bind(('127.0.0.1', 0))
+    server.settimeout(1)
+    client.settimeout(1)
+
+    def lossy_link(sender, receiver, datagrams):
+        # Drop some datagrams and swap neighbours to simulate a bad link,
+        # a few at a time so the loopback socket buffer never overflows
+        received = []
+        for start in range(0, len(datagrams), 16):
+            kept = [d for d in datagrams[start:start + 16] if rng.random() >= loss]
+            for i in range(len(kept) - 1):
+                if rng.random() < reorder:
+                    kept[i], kept[i + 1] = kept[i + 1], kept[i]
+            for d in kept:
+                sender.sendto(d, receiver.getsockname())
+            received.extend(receiver.recv(MAX_DATAGRAM) for _ in kept)
+        return received
+
+    # Snapshots: server -> client, newest wins
+    snapshots = [DatagramChannel.pack(KIND_SNAPSHOT, tick, struct.pack('!I', tick)) for tick in range(1, packets + 1)]
+    received = lossy_link(server, client, snapshots)
+    channel = DatagramChannel()
+    applied = []
+    for data in received:
+        kind, seq, payload = DatagramChannel.unpack(data)
+        if channel.accept(seq):
+            applied.append(struct.unpack('!I', payload)[0])
+    assert applied == sorted(applied), "snapshots went backwards"
+    print(f"snapshots: sent {packets}, delivered {len(received)}, applied {len(applied)}, "
+          f"dropped as stale {channel.stale}, newest applied {applied[-1]}")
+
+    # Inputs: client -> server, each packet repeats the last few inputs
+    history = InputHistory()
+    datagrams = []
+    for seq in range(1, packets + 1):
+        history.add({'seq': seq, 'dx': 1, 'dy': 0, 'angle': 0, 'shoot': False, 'mouse_x': 0, 'mouse_y': 0})
+        datagrams.append(history.packet(seq))
+    received = lossy_link(client, server, datagrams)
+    seen = set()
+    for data in received:
+        kind, seq, payload = DatagramChannel.unpack(data)
+        _, inputs = unpack_inputs(payload)
+        seen.update(i['seq'] for i in inputs)
+    print(f"inputs: sent {packets} in {packets} packets, packets delivered {len(received)}, "
+          f"inputs recovered {len(seen)} ({100 * len(seen) / packets:.1f}%)")
+
+    server.close()
+    client.close()
+
+
+if __name__ == '__main__':
+    loopback_demo()
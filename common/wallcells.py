@@ -0,0 +1,61 @@
+import numpy as np
+
+CELL_MASK = (1 << 21) - 1
+
+
+def cell_keys(cx, cy):
+    # Cell coordinates wrap at 21 bits each. Cells that far apart share a
+    # key, which can only make a lookup find a wall cell that is not there.
+    return ((cx & CELL_MASK) << 21) | (cy & CELL_MASK)
+
+
+class WallCells:
+    """Which cells of a WallIndex hold walls, looked up for whole arrays at once.
+
+    Tells the server which bullets and enemies are nowhere near a wall, so
+    only the rest go through the exact WallIndex queries. Each grid's cells
+    are kept as sorted keys, patched from the grid's change log when it is
+    recent enough and rebuilt when it is not.
+    """
+
+    def __init__(self, walls):
+        self.walls = walls
+        self.keys = {}  # WallGrid -> (its version, its cells as sorted keys)
+
+    def _grid_keys(self, grid):
+        version, keys = self.keys.get(grid, (None, None))
+        behind = grid.version - version if version is not None else None
+        if behind is None or behind > len(grid.changes):
+            cells = np.array(list(grid.cells), dtype=np.int64).reshape(-1, 2)
+            keys = np.sort(cell_keys(cells[:, 0], cells[:, 1]))
+        elif behind:
+            for (cx, cy), created in list(grid.changes)[-behind:]:
+                key = int(cell_keys(np.int64(cx), np.int64(cy)))
+                at = np.searchsorted(keys, key)
+                keys = np.insert(keys, at, key) if created else np.delete(keys, at)
+        self.keys[grid] = (grid.version, keys)
+        return keys
+
+    def _occupied(self, grid, cx, cy):
+        keys = self._grid_keys(grid)
+        wanted = cell_keys(cx, cy)
+        return keys[np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)] == wanted
+
+    def rects(self, left, top, right, bottom):
+        """Rects touching a cell that holds a wall, given as inclusive integer bounds."""
+        left, top, right, bottom = (np.asarray(a, dtype=np.int64) for a in (left, top, right, bottom))
+        found = np.zeros(len(left), dtype=bool)
+        if not len(left):
+            return found
+        for grid in (self.walls.static, self.walls.dynamic):
+            if not grid.cells:
+                continue
+            cs = grid.cell_size
+            cx, cy = left // cs, top // cs
+            span_x, span_y = right // cs - cx, bottom // cs - cy
+            # Every cell of the largest rect's span, relative to each rect's first one
+            wide, high = int(span_x.max()) + 1, int(span_y.max()) + 1
+            ox, oy = np.divmod(np.arange(wide * high), high)
+            occupied = self._occupied(grid, cx[:, None] + ox, cy[:, None] + oy)
+            found |= (occupied & (ox <= span_x[:, None]) & (oy <= span_y[:, None])).any(axis=1)
+        return found
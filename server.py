@@ -1,29 +1,96 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import os
 import socket
 import threading
 import time
 import random
 import math
 import pygame
-from common.game_objects import Player, Enemy, Bullet, Wall, LootBox, get_random_weapon, Mine, Pickup
-from common.network import NetworkProtocol, GameState
+from common.game_objects import Player, Enemy, Wall, LootBox, get_random_weapon, Mine, Pickup
+from common.network import NetworkProtocol, GameState, SnapshotFrames, FrameReader
+from common.codec import Snapshot, SnapshotHistory, SECTIONS
+from common.maps import MapLayout
+from common.connection import ClientConnection, AsyncClientConnection
+from common.codec import ProtocolError
+from common.udp import DatagramChannel, KIND_HELLO, KIND_INPUT, MAX_DATAGRAM, unpack_inputs
+from common.interest import InterestArea, INTEREST_SECTIONS, build_interest_index
+from common.movement import move_player, INPUT_RATE, MAX_INPUTS_PER_TICK
+from common.interpolation import TICK_RATE
+from common.timestep import FixedTimestep
+from common.registry import EntityRegistry, IdAllocator
+from common.spatial import WallIndex, LineOfSight
+from common.bullets import BulletPool
+from common.enemies import EnemySteering
+from common.navigation import NavGrid, FlowField, corner_nudge
+from common.wallcells import WallCells
+
+STATS_INTERVAL = 10  # Seconds between tick statistics with --stats
+FLOW_FIELD_RATE = 10  # Enemy flow field recomputations per second
+
+class DatagramServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, address):
+        try:
+            self.server.handle_datagram(data, address)
+        except ProtocolError:
+            pass  # Stray or malformed datagram
 
 class GameServer:
-    def __init__(self, host='0.0.0.0', port=5555):
+    def __init__(self, host='0.0.0.0', port=5555, backlog=3, udp=False, aoi=False, send_rate=30,
+                 tick_rate=TICK_RATE, stats=False):
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.bind((host, port))
-        self.server.listen(3)  # Allow up to 3 players
+        self.server.listen(backlog)  # Pending connections, 3 is plenty for the threaded LAN server
+
+        # Optional datagram transport on the same port number. Clients bind
+        # their UDP address with the token they got over TCP.
+        self.udp_socket = None
+        if udp:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket.bind((host, self.server.getsockname()[1]))
+        self.udp_tokens = {}  # token -> player_id
+        self.udp_peers = {}  # player_id -> address
+        self.udp_players = {}  # address -> player_id
+        self.udp_channels = {}  # player_id -> DatagramChannel for inputs
+        self.last_input_seq = {}  # Newest input applied per player
+        self.send_rate = send_rate  # Snapshots per second, clients interpolate between them
+
+        # Simulation runs at a fixed rate of real time; timers and enemy
+        # movement advance by dt per tick, bullets and contact damage per tick
+        self.tick_rate = tick_rate
+        self.dt = 1 / tick_rate
+        self.timestep = FixedTimestep(tick_rate)
+        # Clients send INPUT_RATE inputs a second however fast the server ticks
+        self.max_inputs_per_tick = MAX_INPUTS_PER_TICK * math.ceil(INPUT_RATE / tick_rate)
+        self.stats = stats  # Print tick statistics every STATS_INTERVAL seconds
+        self.next_stats = time.monotonic() + STATS_INTERVAL
+
+        # Area of interest: only send each client what is near its camera
+        self.aoi = aoi
+        self.interest_areas = {}  # player_id -> InterestArea
+        self.client_histories = {}  # player_id -> SnapshotHistory of its filtered snapshots
         self.game_state = GameState()
         self.clients = {}
+        self.player_ids = itertools.count()
         self.running = True
         self.last_enemy_spawn = 0
         self.enemy_spawn_delay = 3  # seconds
         self.player_inputs = {}  # Store latest input for each player
+        self.input_queues = {}  # player_id -> inputs not simulated yet, one step each
         self.last_shot_times = {}  # For special weapons
         self.game_over = False
         self.wave = 1
         self.wave_in_progress = False
         self.wave_cooldown = 0
         self.zombies_to_spawn = 0
+        self.snapshot_tick = 0
+        self.snapshot_history = SnapshotHistory()  # Delta baselines
+        self.snapshot_acks = {}  # Last snapshot tick each client has received
 
         # Initialize scores in game state
         self.game_state.scores = {}
@@ -46,513 +113,683 @@ class GameServer:
             Wall(300, 300, 20, 100),
             Wall(480, 300, 20, 100),
         ]
-        self.game_state.lootboxes = []
-        self.game_state.mines = []
+        # Static geometry is sent once per connection, see handle_client
+        self.game_state.map_layout = MapLayout(list(self.game_state.walls))
+        # Every wall collision goes through this, keep it in step with game_state.walls
+        self.wall_index = WallIndex(self.game_state.walls)
+        self.wall_cells = WallCells(self.wall_index)
+        self.line_of_sight = LineOfSight(self.wall_index)  # Shooters only fire at players they can see
+        # Enemies find their way to the players through this, it covers the map
+        map_rect = self.game_state.walls[0].rect.unionall([wall.rect for wall in self.game_state.walls])
+        self.nav_grid = NavGrid((map_rect.left, map_rect.top, map_rect.right, map_rect.bottom), beyond=self.wall_cells)
+        self.flow_field = FlowField(self.nav_grid, interval=max(1, round(self.tick_rate / FLOW_FIELD_RATE)))
+        self.damaged_walls = set()  # Hit by enemies or destroyed by bullets this tick, removed at its end if destroyed
+        self.wall_ids = IdAllocator()  # Player walls only, static ones are keyed by map layout index
+        # Dense storage with generational ids, these are keyed by id in snapshots
+        self.game_state.enemies = EntityRegistry()
+        self.game_state.bullets = BulletPool()
+        self.game_state.lootboxes = EntityRegistry()
+        self.game_state.mines = EntityRegistry()
+        self.game_state.pickups = EntityRegistry()
 
         print(f"Server started on {host}:{port}")
         print("Waiting for players to connect...")
 
-    def handle_client(self, client_socket, address):
-        player_id = len(self.clients)
+    def add_player(self, connection):
+        player_id = next(self.player_ids)
         player = Player(400, 300, player_id)  # Spawn in center
         self.game_state.players[player_id] = player
-        self.clients[player_id] = client_socket
+        self.clients[player_id] = connection
         self.player_inputs[player_id] = {'dx': 0, 'dy': 0, 'angle': 0, 'shoot': False, 'mouse_x': 0, 'mouse_y': 0}
         self.last_shot_times[player_id] = 0
+        self.last_input_seq[player_id] = 0
+        self.input_queues[player_id] = collections.deque(maxlen=60)
+        return player_id
+
+    def remove_player(self, player_id):
+        if player_id in self.game_state.players:
+            del self.game_state.players[player_id]
+        if player_id in self.clients:
+            del self.clients[player_id]
+        if player_id in self.player_inputs:
+            del self.player_inputs[player_id]
+        if player_id in self.last_shot_times:
+            del self.last_shot_times[player_id]
+        self.snapshot_acks.pop(player_id, None)
+        self.last_input_seq.pop(player_id, None)
+        self.input_queues.pop(player_id, None)
+        self.interest_areas.pop(player_id, None)
+        self.client_histories.pop(player_id, None)
+        self.udp_channels.pop(player_id, None)
+        for token, pid in list(self.udp_tokens.items()):
+            if pid == player_id:
+                del self.udp_tokens[token]
+        address = self.udp_peers.pop(player_id, None)
+        if address is not None:
+            self.udp_players.pop(address, None)
+
+    def handle_message(self, player_id, message, reply):
+        if message['type'] == 'snapshot_ack':
+            self.snapshot_acks[player_id] = message['data']['tick']
+        elif message['type'] == 'map_request':
+            reply({
+                'type': 'map',
+                'data': self.game_state.map_layout.data
+            })
+        elif message['type'] == 'player_input':
+            # Applied by the next tick; the client predicts the same step locally
+            data = message['data']
+            inputs = self.input_queues.get(player_id)
+            if inputs is None:
+                return  # A late datagram from a player who has just left
+            inputs.append(data)
+            self.last_input_seq[player_id] = data['seq']
+        elif message['type'] == 'switch_weapon':
+            idx = message['data']['selected_weapon_index']
+            player = self.game_state.players.get(player_id)
+            if player and 0 <= idx < len(player.weapons):
+                player.selected_weapon_index = idx
+                reply({
+                    'type': 'switch_weapon_ack',
+                    'data': {'selected_weapon_index': idx}
+                })
+        elif message['type'] == 'restart_game':
+            for p in self.game_state.players.values():
+                p.respawn()
+                # Reset input state for all players
+                for pid in self.player_inputs:
+                    self.player_inputs[pid] = {'dx': 0, 'dy': 0, 'angle': 0, 'shoot': False, 'mouse_x': 0, 'mouse_y': 0}
+                    self.input_queues[pid].clear()
+            self.game_over = False
+            self.wave = 1
+            self.wave_cooldown = 0
+            self.wave_in_progress = False
+            self.zombies_to_spawn = 0
+            self.game_state.scores = {}  # Reset scores on game restart
+
+    def client_stats(self):
+        return {pid: connection.queue.stats() for pid, connection in list(self.clients.items())}
+
+    def handle_datagram(self, data, address):
+        kind, seq, payload = DatagramChannel.unpack(data)
+        if kind == KIND_HELLO:
+            player_id = self.udp_tokens.get(bytes(payload))
+            if player_id is not None and player_id in self.clients:
+                self.udp_peers[player_id] = address
+                self.udp_players[address] = player_id
+                self.udp_channels[player_id] = DatagramChannel()
+            return
+        player_id = self.udp_players.get(address)
+        if player_id is None or kind != KIND_INPUT:
+            return
+        # The player may have left on its TCP thread since the lookup above
+        channel = self.udp_channels.get(player_id)
+        if channel is None or not channel.accept(seq):
+            return  # Gone, or older than an input packet we already handled
+        ack_tick, inputs = unpack_inputs(payload)
+        self.snapshot_acks[player_id] = ack_tick
+        # Inputs lost with earlier packets are still in this one, apply them in order
+        for input_data in inputs:
+            if input_data['seq'] > self.last_input_seq.get(player_id, 0):
+                self.handle_message(player_id, {'type': 'player_input', 'data': input_data}, None)
+
+    def receive_datagrams(self):
+        while self.running:
+            try:
+                data, address = self.udp_socket.recvfrom(MAX_DATAGRAM)
+            except OSError:
+                return
+            try:
+                self.handle_datagram(data, address)
+            except ProtocolError:
+                pass  # Stray or malformed datagram
+
+    def send_datagram(self, player_id, data):
+        try:
+            self.udp_socket.sendto(data, self.udp_peers[player_id])
+        except (OSError, KeyError):
+            pass  # Unreliable by design, the next snapshot replaces it
+
+    def udp_info_message(self, player_id):
+        token = os.urandom(8)
+        self.udp_tokens[token] = player_id
+        return {'type': 'udp_info', 'data': {'port': self.udp_socket.getsockname()[1], 'token': token.hex()}}
+
+    def welcome_message(self, player_id):
+        return {'type': 'welcome', 'data': {'player_id': player_id, 'tick_rate': self.tick_rate}}
+
+    def map_info_message(self):
+        return {'type': 'map_info', 'data': {'hash': self.game_state.map_layout.hash}}
 
+    def handle_client(self, client_socket, address):
+        connection = ClientConnection(client_socket)
+        player_id = self.add_player(connection)
         try:
+            connection.send(self.welcome_message(player_id))
+            connection.send(self.map_info_message())
+            if self.udp_socket is not None:
+                connection.send(self.udp_info_message(player_id))
+            reader = FrameReader(client_socket)
             while self.running:
-                message = NetworkProtocol.receive_message(client_socket)
+                message = reader.receive_message()
                 if message is None:
                     break
-                if message['type'] == 'player_input':
-                    if self.game_state.players[player_id].dead:
-                        continue
-                    data = message['data']
-                    self.player_inputs[player_id] = data
-                elif message['type'] == 'switch_weapon':
-                    idx = message['data']['selected_weapon_index']
-                    player = self.game_state.players.get(player_id)
-                    if player and 0 <= idx < len(player.weapons):
-                        player.selected_weapon_index = idx
-                        NetworkProtocol.send_message(client_socket, {
-                            'type': 'switch_weapon_ack',
-                            'data': {'selected_weapon_index': idx}
-                        })
-                elif message['type'] == 'restart_game':
-                    for p in self.game_state.players.values():
-                        p.respawn()
-                        # Reset input state for all players
-                        for pid in self.player_inputs:
-                            self.player_inputs[pid] = {'dx': 0, 'dy': 0, 'angle': 0, 'shoot': False, 'mouse_x': 0, 'mouse_y': 0}
-                    self.game_over = False
-                    self.wave = 1
-                    self.wave_cooldown = 0
-                    self.wave_in_progress = False
-                    self.zombies_to_spawn = 0
-                    self.game_state.scores = {}  # Reset scores on game restart
+                self.handle_message(player_id, message, connection.send)
         except Exception as e:
             print(f"Error handling client {address}: {e}")
         finally:
-            if player_id in self.game_state.players:
-                del self.game_state.players[player_id]
-            if player_id in self.clients:
-                del self.clients[player_id]
-            if player_id in self.player_inputs:
-                del self.player_inputs[player_id]
-            if player_id in self.last_shot_times:
-                del self.last_shot_times[player_id]
+            self.remove_player(player_id)
+            connection.close()
             client_socket.close()
+            print(f"Client {address} disconnected, send queue {connection.queue.stats()}")
+
+    async def handle_client_async(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        print(f"New connection from {address}")
+        connection = AsyncClientConnection(writer)
+        player_id = self.add_player(connection)
+        try:
+            connection.send(self.welcome_message(player_id))
+            connection.send(self.map_info_message())
+            if self.udp_socket is not None:
+                connection.send(self.udp_info_message(player_id))
+            while self.running:
+                message = await NetworkProtocol.receive_message_async(reader)
+                if message is None:
+                    break
+                self.handle_message(player_id, message, connection.send)
+        except Exception as e:
+            print(f"Error handling client {address}: {e}")
+        finally:
+            self.remove_player(player_id)
+            connection.close()
+            writer.close()
+            print(f"Client {address} disconnected, send queue {connection.queue.stats()}")
 
     def update_game_state(self):
+        # Snapshots are built on this thread too, between ticks, so they never
+        # see a tick half done, as in async mode where both share the event loop
+        next_send = time.monotonic()
         while self.running:
-            # --- Fale zombie ---
-            if not self.wave_in_progress and self.wave_cooldown <= 0:
-                self.wave_in_progress = True
-                self.zombies_to_spawn = 5 + self.wave
-                self.spawned_this_wave = 0
-            if self.wave_in_progress and self.zombies_to_spawn > 0:
-                if len(self.game_state.enemies) < 10:
-                    spawn_successful = False
-                    attempts = 0
-                    while not spawn_successful and attempts < 50:
-                        x = random.randint(50, 750)
-                        y = random.randint(50, 550)
+            self.timestep.run(self.tick)
+            self.report_stats()
+            now = time.monotonic()
+            if now >= next_send:
+                next_send = max(next_send + 1/self.send_rate, now)
+                self.broadcast()
+            time.sleep(min(self.timestep.delay(), max(0.0, next_send - time.monotonic())))
+
+    def report_stats(self):
+        if self.stats and time.monotonic() >= self.next_stats:
+            self.next_stats += STATS_INTERVAL
+            print(f"Tick stats: {self.timestep.stats()}")
+            for pid, queue_stats in self.client_stats().items():
+                print(f"Player {pid} send queue: {queue_stats}")
+
+    def tick(self):
+        self.game_state.frame += 1
+
+        # --- Fale zombie ---
+        if not self.wave_in_progress and self.wave_cooldown <= 0:
+            self.wave_in_progress = True
+            self.zombies_to_spawn = 5 + self.wave
+            self.spawned_this_wave = 0
+        if self.wave_in_progress and self.zombies_to_spawn > 0:
+            if len(self.game_state.enemies) < 10:
+                spawn_successful = False
+                attempts = 0
+                while not spawn_successful and attempts < 50:
+                    x = random.randint(50, 750)
+                    y = random.randint(50, 550)
+                    
+                    # Wybór typu przeciwnika
+                    if self.wave == 5:
+                        # Na 5 poziomie spawnuj bossa
+                        enemy_type = 5
+                    else:
+                        # Na innych poziomach normalna logika
+                        enemy_type = random.randint(1, 4)
                         
-                        # Wybór typu przeciwnika
+                    enemy_size = Enemy(x, y, enemy_type).size
+                    enemy_rect = pygame.Rect(x - enemy_size, y - enemy_size, enemy_size*2, enemy_size*2)
+                    
+                    collides_with_wall = self.wall_index.collide_rect(enemy_rect) is not None
+                            
+                    if not collides_with_wall:
+                        # Na poziomie 5 spawnuj tylko jednego bossa
                         if self.wave == 5:
-                            # Na 5 poziomie spawnuj bossa
-                            enemy_type = 5
+                            self.game_state.enemies.clear()  # Usuń wszystkich innych przeciwników
+                            self.game_state.enemies.add(Enemy(x, y, enemy_type))
+                            self.zombies_to_spawn = 0  # Nie spawnuj więcej przeciwników w tej fali
                         else:
-                            # Na innych poziomach normalna logika
-                            enemy_type = random.randint(1, 4)
-                            
-                        enemy_size = Enemy(x, y, enemy_type).size
-                        enemy_rect = pygame.Rect(x - enemy_size, y - enemy_size, enemy_size*2, enemy_size*2)
-                        
-                        collides_with_wall = False
-                        for wall in self.game_state.walls:
-                            if wall.rect.colliderect(enemy_rect):
-                                collides_with_wall = True
-                                break
-                                
-                        if not collides_with_wall:
-                            # Na poziomie 5 spawnuj tylko jednego bossa
-                            if self.wave == 5:
-                                self.game_state.enemies = []  # Usuń wszystkich innych przeciwników
-                                self.game_state.enemies.append(Enemy(x, y, enemy_type))
-                                self.zombies_to_spawn = 0  # Nie spawnuj więcej przeciwników w tej fali
-                            else:
-                                self.game_state.enemies.append(Enemy(x, y, enemy_type))
-                                self.zombies_to_spawn -= 1
-                            spawn_successful = True
-                        
-                        attempts += 1
-                        
-                    if not spawn_successful:
-                         print("Warning: Could not find a valid spawn location for enemy after 50 attempts.")
-            if self.wave_in_progress and self.zombies_to_spawn == 0 and len(self.game_state.enemies) == 0:
-                self.wave_in_progress = False
-                self.wave_cooldown = 5
-                self.wave += 1
-            if not self.wave_in_progress and self.wave_cooldown > 0:
-                self.wave_cooldown -= 1/60
-                if self.wave_cooldown < 0:
-                    self.wave_cooldown = 0
-            self.game_state.wave = self.wave
-            self.game_state.wave_cooldown = self.wave_cooldown
-
-            all_dead = True
-            for player in self.game_state.players.values():
-                if player.dead:
-                    if player.respawn_timer > 0:
-                        player.respawn_timer -= 1/60
-                        if player.respawn_timer <= 0:
-                            player.respawn()
-                    continue
-                all_dead = False
-            if all_dead and len(self.game_state.players) > 0:
-                self.game_over = True
-            else:
-                self.game_over = False
-            self.game_state.game_over = self.game_over
-
-            # Update player positions based on input
-            for pid, player in self.game_state.players.items():
-                if player.dead:
-                    continue
-                input_data = self.player_inputs.get(pid, {'dx': 0, 'dy': 0, 'angle': 0, 'shoot': False, 'mouse_x': player.x, 'mouse_y': player.y})
-                dx = input_data['dx']
-                dy = input_data['dy']
-                angle = input_data['angle']
-                shoot = input_data['shoot']
-                mouse_x = input_data.get('mouse_x', player.x)
-                mouse_y = input_data.get('mouse_y', player.y)
-
-                # Normalize diagonal movement
-                if dx != 0 and dy != 0:
-                    dx *= 0.7071
-                    dy *= 0.7071
-
-                # Ruch gracza z kolizją ścian
-                new_x = player.x + dx * player.speed
-                new_y = player.y + dy * player.speed
-                player_rect = pygame.Rect(new_x - player.size, new_y - player.size, player.size*2, player.size*2)
-                collision = False
-                for wall in self.game_state.walls:
-                    if wall.rect.colliderect(player_rect):
-                        collision = True
-                        break
-                if not collision:
-                    player.x = new_x
-                    player.y = new_y
-                player.angle = angle
-
-                # Special weapon logic
-                weapon = getattr(player, 'current_weapon', None)
-                now = time.time() * 1000
-                if shoot and weapon:
-                    if weapon.special_type == 'wall':
-                        if now - self.last_shot_times.get(pid, 0) > weapon.fire_rate and player.ammo.get(weapon.name, 0) > 0:
-                            self.last_shot_times[pid] = now
-                            wall_w, wall_h = 40, 40
-                            self.game_state.walls.append(Wall(mouse_x - wall_w//2, mouse_y - wall_h//2, wall_w, wall_h, is_player_wall=True))
-                            player.ammo[weapon.name] -= 1 # Consume ammo for wall spawner
-
-                    elif weapon.special_type == 'mine':
-                        if now - self.last_shot_times.get(pid, 0) > weapon.fire_rate and player.ammo.get(weapon.name, 0) > 0:
-                            self.last_shot_times[pid] = now
-                            self.game_state.mines.append(Mine(player.x, player.y, pid, weapon.damage))
-                            player.ammo[weapon.name] -= 1 # Consume ammo for mine placer
-
-                    elif weapon.name == "Shotgun": # Handle Shotgun
-                         if now - self.last_shot_times.get(pid, 0) > weapon.fire_rate and player.ammo.get(weapon.name, 0) > 0:
-                             self.last_shot_times[pid] = now
-                             player.ammo[weapon.name] -= 1 # Consume ammo
-                             # Create multiple bullets with spread
-                             spread_angle = 15 # Degrees total spread
-                             num_bullets = 3
-                             for i in range(num_bullets):
-                                 angle_offset = (i - (num_bullets - 1) / 2) * (spread_angle / num_bullets)
-                                 bullet_angle = player.angle + angle_offset
-                                 # Use a different color for shotgun bullets to distinguish them
-                                 shotgun_bullet = Bullet(player.x, player.y, bullet_angle, player.player_id, weapon)
-                                 shotgun_bullet.color = (255, 165, 0) # Orange color for shotgun bullets
-                                 self.game_state.bullets.append(shotgun_bullet)
-
-                    else: # Handle regular bullets (Pistol, Weapon 2, Weapon 3)
-                        if now - self.last_shot_times.get(pid, 0) > weapon.fire_rate and player.ammo.get(weapon.name, 0) > 0: # Check ammo for regular guns too
-                            self.last_shot_times[pid] = now
-                            player.ammo[weapon.name] -= 1 # Consume ammo
-                            bullet = Bullet(player.x, player.y, player.angle, player.player_id, weapon)
-                            self.game_state.bullets.append(bullet)
-
-            # Update bullets
-            for bullet in self.game_state.bullets[:]:
-                bullet.update()
-                if bullet.lifetime <= 0:
-                    self.game_state.bullets.remove(bullet)
-                    continue
+                            self.game_state.enemies.add(Enemy(x, y, enemy_type))
+                            self.zombies_to_spawn -= 1
+                        spawn_successful = True
+                    
+                    attempts += 1
+                    
+                if not spawn_successful:
+                     print("Warning: Could not find a valid spawn location for enemy after 50 attempts.")
+        if self.wave_in_progress and self.zombies_to_spawn == 0 and len(self.game_state.enemies) == 0:
+            self.wave_in_progress = False
+            self.wave_cooldown = 5
+            self.wave += 1
+        if not self.wave_in_progress and self.wave_cooldown > 0:
+            self.wave_cooldown -= self.dt
+            if self.wave_cooldown < 0:
+                self.wave_cooldown = 0
+        self.game_state.wave = self.wave
+        self.game_state.wave_cooldown = self.wave_cooldown
+
+        all_dead = True
+        for player in self.game_state.players.values():
+            if player.dead:
+                if player.respawn_timer > 0:
+                    player.respawn_timer -= self.dt
+                    if player.respawn_timer <= 0:
+                        player.respawn()
+                continue
+            all_dead = False
+        if all_dead and len(self.game_state.players) > 0:
+            self.game_over = True
+        else:
+            self.game_over = False
+        self.game_state.game_over = self.game_over
+
+        # Update player positions based on input
+        for pid, player in self.game_state.players.items():
+            inputs = self.input_queues.get(pid, ())
+            if player.dead:
+                # Acknowledged without moving, so the client drops them from its replay
+                while inputs:
+                    player.input_seq = inputs.popleft()['seq']
+                continue
+            # Every queued input is one movement step, exactly as the client predicted it
+            for _ in range(min(len(inputs), self.max_inputs_per_tick)):
+                input_data = inputs.popleft()
+                player.x, player.y = move_player(player.x, player.y, input_data['dx'], input_data['dy'],
+                                                 player.speed, player.size, self.wall_index)
+                player.input_seq = input_data['seq']
+                self.player_inputs[pid] = input_data
+            input_data = self.player_inputs.get(pid, {'dx': 0, 'dy': 0, 'angle': 0, 'shoot': False, 'mouse_x': player.x, 'mouse_y': player.y})
+            angle = input_data['angle']
+            shoot = input_data['shoot']
+            mouse_x = input_data.get('mouse_x', player.x)
+            mouse_y = input_data.get('mouse_y', player.y)
+            player.angle = angle
+
+            # Special weapon logic
+            weapon = getattr(player, 'current_weapon', None)
+            now = time.time() * 1000
+            if shoot and weapon:
+                if weapon.special_type == 'wall':
+                    if now - self.last_shot_times.get(pid, 0) > weapon.fire_rate and player.ammo.get(weapon.name, 0) > 0:
+                        self.last_shot_times[pid] = now
+                        wall_w, wall_h = 40, 40
+                        self.add_player_wall(Wall(mouse_x - wall_w//2, mouse_y - wall_h//2, wall_w, wall_h, is_player_wall=True))
+                        player.ammo[weapon.name] -= 1 # Consume ammo for wall spawner
+
+                elif weapon.special_type == 'mine':
+                    if now - self.last_shot_times.get(pid, 0) > weapon.fire_rate and player.ammo.get(weapon.name, 0) > 0:
+                        self.last_shot_times[pid] = now
+                        self.game_state.mines.add(Mine(player.x, player.y, pid, weapon.damage))
+                        player.ammo[weapon.name] -= 1 # Consume ammo for mine placer
+
+                elif weapon.name == "Shotgun": # Handle Shotgun
+                     if now - self.last_shot_times.get(pid, 0) > weapon.fire_rate and player.ammo.get(weapon.name, 0) > 0:
+                         self.last_shot_times[pid] = now
+                         player.ammo[weapon.name] -= 1 # Consume ammo
+                         # Create multiple bullets with spread
+                         spread_angle = 15 # Degrees total spread
+                         num_bullets = 3
+                         for i in range(num_bullets):
+                             angle_offset = (i - (num_bullets - 1) / 2) * (spread_angle / num_bullets)
+                             bullet_angle = player.angle + angle_offset
+                             # Use a different color for shotgun bullets to distinguish them
+                             self.game_state.bullets.spawn(player.x, player.y, bullet_angle, player.player_id,
+                                                           weapon.bullet_speed, weapon.damage, (255, 165, 0)) # Orange color for shotgun bullets
+
+                else: # Handle regular bullets (Pistol, Weapon 2, Weapon 3)
+                    if now - self.last_shot_times.get(pid, 0) > weapon.fire_rate and player.ammo.get(weapon.name, 0) > 0: # Check ammo for regular guns too
+                        self.last_shot_times[pid] = now
+                        player.ammo[weapon.name] -= 1 # Consume ammo
+                        self.game_state.bullets.spawn(player.x, player.y, player.angle, player.player_id,
+                                                      weapon.bullet_speed, weapon.damage, weapon.icon_color)
+
+        # Update bullets. Moving, expiring and the broad hit tests run on all
+        # of them at once; only bullets touching something are handled one
+        # by one, in spawn order. Nothing but bullets moves until they are done.
+        bullets = self.game_state.bullets
+        bullets.advance()
+        enemies = self.game_state.enemies
+        enemy_list = list(enemies)
+        player_list = list(self.game_state.players.values())
+        enemy_near, enemy_hits = bullets.circle_hits([(e.x, e.y, e.size) for e in enemy_list])
+        player_near, player_hits = bullets.circle_hits([(p.x, p.y, p.size) for p in player_list])
+        self.nav_grid.sync(self.wall_index)  # Walls built this tick
+        wall_candidates = bullets.wall_candidates(self.nav_grid)
+        for i, bullet in bullets.select(wall_candidates | enemy_near | player_near):
+            # Check bullet collisions with walls, along its whole way this frame
+            hit = bullets.wall_hit(i, self.wall_index) if wall_candidates[i] else None
+            if hit is not None:
+                wall = hit[0]
+                wall.health -= bullet.damage
+                if wall.health <= 0:
+                    # Out of the index at once, off the wall list at the end of the tick
+                    self.wall_index.remove(wall)
+                    self.damaged_walls.add(wall)
+                bullets.discard(i)
+                continue  # Pocisk zatrzymał się na ścianie, nie trafia w nic za nią
+
+            # Check bullet collisions with enemies
+            # Pociski graczy (player_id >= 0) kolidują z wrogami
+            hits = []
+            if bullet.player_id >= 0 and enemy_near[i]:
+                # Kills are only compacted away after the mines, so this is still the registry's order
+                hits = [enemy_list[j] for j in enemy_hits[i] if enemy_list[j] in enemies]
+            for enemy in hits:
+                # Damage the enemy
+                enemy.health -= bullet.damage
+                if enemy.health <= 0:
+                    # Award points based on enemy type
+                    points = {
+                        1: 100,  # Basic zombie
+                        2: 200,  # Stronger zombie
+                        3: 500,  # Boss zombie
+                        4: 300   # Shooter zombie
+                    }.get(enemy.type, 100)
+                    
+                    # Initialize score for player if not exists
+                    if bullet.player_id not in self.game_state.scores:
+                        self.game_state.scores[bullet.player_id] = 0
+                    
+                    # Add points to player's score
+                    self.game_state.scores[bullet.player_id] += points
+                    
+                    # Chance to drop health or armor (30% total: 20% health, 10% armor)
+                    drop_roll = random.random()
+                    if drop_roll < 0.2:  # 20% chance for health
+                        self.game_state.pickups.add(Pickup(enemy.x, enemy.y, 'health', 50))
+                    elif drop_roll < 0.3:  # 10% chance for armor
+                        self.game_state.pickups.add(Pickup(enemy.x, enemy.y, 'armor', 100))
+                    else:  # 70% chance for weapon
+                        self.game_state.lootboxes.add(LootBox(enemy.x, enemy.y))
+                    
+                    enemies.discard(enemy)
+                # Remove the bullet
+                if bullets.alive(i):
+                    bullets.discard(i)
+                    break
 
-                # Check bullet collisions with walls
-                for wall in self.game_state.walls[:]:
-                    if wall.rect.collidepoint(bullet.x, bullet.y):
-                        wall.health -= bullet.damage
-                        if wall.health <= 0:
-                            self.game_state.walls.remove(wall)
-                        if bullet in self.game_state.bullets:
-                            self.game_state.bullets.remove(bullet)
-                        break
-
-                # Check bullet collisions with enemies
-                for enemy in self.game_state.enemies[:]:
-                    # Pociski graczy (player_id >= 0) kolidują z wrogami
-                    if bullet.player_id >= 0 and ((bullet.x - enemy.x) ** 2 + (bullet.y - enemy.y) ** 2) ** 0.5 < enemy.size:
-                        # Damage the enemy
-                        enemy.health -= bullet.damage if hasattr(bullet, 'damage') else 25
-                        if enemy.health <= 0:
-                            # Award points based on enemy type
+            # Check bullet collisions with players
+            for j in player_hits.get(i, ()):
+                player = player_list[j]
+                # Pociski wrogów (player_id == -1) kolidują z graczami
+                # Pociski graczy (player_id >= 0) nie kolidują z własnymi graczami (sprawdzane przez player.player_id != bullet.player_id)
+                if bullet.player_id == -1 or (bullet.player_id >= 0 and player.player_id != bullet.player_id):
+                    if not player.dead:
+                        # Gracz otrzymał obrażenia od pocisku wroga lub innego gracza
+                        player.take_damage(bullet.damage)
+                        if player.health <= 0 and not player.dead:
+                            player.kill()
+                        if bullets.alive(i):
+                            bullets.discard(i)
+                        break # Pocisk trafił w gracza, usuń pocisk
+        bullets.compact()
+
+        # Player picks up items. Taken ones are only discarded, so the loops
+        # skip items another player took first, and compacted after them.
+        pickups, lootboxes = self.game_state.pickups, self.game_state.lootboxes
+        for player in self.game_state.players.values():
+            if player.dead:
+                continue
+            
+            # Check for pickup collisions
+            for pickup in pickups:
+                if ((player.x - pickup.x) ** 2 + (player.y - pickup.y) ** 2) ** 0.5 < player.size + pickup.size and pickup in pickups:
+                    if pickup.pickup_type == 'health':
+                        player.add_health(pickup.value)
+                    else:  # armor
+                        player.add_armor(pickup.value)
+                    pickups.discard(pickup)
+
+            # Check for lootbox collisions
+            for lootbox in lootboxes:
+                if ((player.x - lootbox.x) ** 2 + (player.y - lootbox.y) ** 2) ** 0.5 < player.size + lootbox.size and lootbox in lootboxes:
+                    player.add_weapon(lootbox.weapon)
+                    lootboxes.discard(lootbox)
+        pickups.compact()
+        lootboxes.compact()
+
+        # Update mines and check for explosions. Enemies killed by bullets or
+        # blasts are still met here, dead ones are skipped until the compact
+        mines = self.game_state.mines
+        for mine in mines:
+            if not mine.active:
+                mines.discard(mine)  # Remove inactive mines
+                continue
+            
+            exploded = False
+            for enemy in enemies:
+                if ((mine.x - enemy.x) ** 2 + (mine.y - enemy.y) ** 2) ** 0.5 < mine.size + enemy.size and enemy in enemies:
+                    # Mine explodes on contact
+                    exploded = True
+                    break # Explode only once per enemy contact
+
+            if exploded:
+                # Apply blast damage to all enemies within radius
+                blast_radius = 100 # Adjust as needed
+                for enemy in enemies:
+                    if ((mine.x - enemy.x) ** 2 + (mine.y - enemy.y) ** 2) ** 0.5 < blast_radius and enemy in enemies:
+                         enemy.health -= mine.damage # Use mine's damage for blast
+                         if enemy.health <= 0:
+                            # Award points for mine kills
                             points = {
-                                1: 100,  # Basic zombie
-                                2: 200,  # Stronger zombie
-                                3: 500,  # Boss zombie
-                                4: 300   # Shooter zombie
-                            }.get(enemy.type, 100)
+                                1: 150,  # Extra points for mine kills
+                                2: 300,
+                                3: 750,
+                                4: 450
+                            }.get(enemy.type, 150)
                             
                             # Initialize score for player if not exists
-                            if bullet.player_id not in self.game_state.scores:
-                                self.game_state.scores[bullet.player_id] = 0
+                            if mine.owner_id not in self.game_state.scores:
+                                self.game_state.scores[mine.owner_id] = 0
                             
                             # Add points to player's score
-                            self.game_state.scores[bullet.player_id] += points
+                            self.game_state.scores[mine.owner_id] += points
                             
-                            # Chance to drop health or armor (30% total: 20% health, 10% armor)
-                            drop_roll = random.random()
-                            if drop_roll < 0.2:  # 20% chance for health
-                                self.game_state.pickups.append(Pickup(enemy.x, enemy.y, 'health', 50))
-                            elif drop_roll < 0.3:  # 10% chance for armor
-                                self.game_state.pickups.append(Pickup(enemy.x, enemy.y, 'armor', 100))
-                            else:  # 70% chance for weapon
-                                self.game_state.lootboxes.append(LootBox(enemy.x, enemy.y))
-                            
-                            self.game_state.enemies.remove(enemy)
-                        # Remove the bullet
-                        if bullet in self.game_state.bullets:
-                            self.game_state.bullets.remove(bullet)
-                            break
-
-                # Check bullet collisions with players
-                for player in self.game_state.players.values():
-                    # Pociski wrogów (player_id == -1) kolidują z graczami
-                    # Pociski graczy (player_id >= 0) nie kolidują z własnymi graczami (sprawdzane przez player.player_id != bullet.player_id)
-                    if bullet.player_id == -1 or (bullet.player_id >= 0 and player.player_id != bullet.player_id):
-                        if not player.dead:
-                            if ((bullet.x - player.x) ** 2 + (bullet.y - player.y) ** 2) ** 0.5 < player.size:
-                                # Gracz otrzymał obrażenia od pocisku wroga lub innego gracza
-                                player.take_damage(bullet.damage)
-                                if player.health <= 0 and not player.dead:
-                                    player.kill()
-                                if bullet in self.game_state.bullets:
-                                    self.game_state.bullets.remove(bullet)
-                                break # Pocisk trafił w gracza, usuń pocisk
-
-            # Player picks up items
-            for player in self.game_state.players.values():
-                if player.dead:
-                    continue
-                
-                # Check for pickup collisions
-                for pickup in self.game_state.pickups[:]:
-                    if ((player.x - pickup.x) ** 2 + (player.y - pickup.y) ** 2) ** 0.5 < player.size + pickup.size:
-                        if pickup.pickup_type == 'health':
-                            player.add_health(pickup.value)
-                        else:  # armor
-                            player.add_armor(pickup.value)
-                        self.game_state.pickups.remove(pickup)
-
-                # Check for lootbox collisions
-                for lootbox in self.game_state.lootboxes[:]:
-                    if ((player.x - lootbox.x) ** 2 + (player.y - lootbox.y) ** 2) ** 0.5 < player.size + lootbox.size:
-                        player.add_weapon(lootbox.weapon)
-                        self.game_state.lootboxes.remove(lootbox)
-
-            # Update mines and check for explosions
-            for mine in self.game_state.mines[:]:
-                if not mine.active:
-                    continue
-                
-                exploded = False
-                for enemy in self.game_state.enemies[:]:
-                    if ((mine.x - enemy.x) ** 2 + (mine.y - enemy.y) ** 2) ** 0.5 < mine.size + enemy.size:
-                        # Mine explodes on contact
-                        exploded = True
-                        break # Explode only once per enemy contact
-
-                if exploded:
-                    # Apply blast damage to all enemies within radius
-                    blast_radius = 100 # Adjust as needed
-                    for enemy in self.game_state.enemies[:]:
-                        if ((mine.x - enemy.x) ** 2 + (mine.y - enemy.y) ** 2) ** 0.5 < blast_radius:
-                             enemy.health -= mine.damage # Use mine's damage for blast
-                             if enemy.health <= 0:
-                                # Award points for mine kills
-                                points = {
-                                    1: 150,  # Extra points for mine kills
-                                    2: 300,
-                                    3: 750,
-                                    4: 450
-                                }.get(enemy.type, 150)
-                                
-                                # Initialize score for player if not exists
-                                if mine.owner_id not in self.game_state.scores:
-                                    self.game_state.scores[mine.owner_id] = 0
-                                
-                                # Add points to player's score
-                                self.game_state.scores[mine.owner_id] += points
-                                
-                                self.game_state.lootboxes.append(LootBox(enemy.x, enemy.y)) # Drop loot on blast kill
-                                self.game_state.enemies.remove(enemy) # Usuń wroga po zabiciu przez minę
-                    mine.active = False # Deactivate mine after explosion
-            # Remove inactive mines
-            self.game_state.mines = [m for m in self.game_state.mines if m.active]
-
-            # Update enemy movement and actions
-            dt = 1/60 # Czas ramki w sekundach
-            now = time.time() * 1000 # Aktualny czas w milisekundach
-            for enemy in self.game_state.enemies[:]: # Iterate over a copy in case enemies are removed
+                            self.game_state.lootboxes.add(LootBox(enemy.x, enemy.y)) # Drop loot on blast kill
+                            enemies.discard(enemy) # Usuń wroga po zabiciu przez minę
+                mine.active = False # Deactivate mine after explosion
+                mines.discard(mine)
+        # Nothing else removes enemies or mines this tick
+        mines.compact()
+        enemies.compact()
+
+        # Update enemy movement and actions. Targets, shooting and chase
+        # moves are worked out for all enemies at once, then each enemy moves
+        # in turn; only those near a wall go through the collision tests.
+        dt = self.dt # Czas ramki w sekundach
+        now = time.time() * 1000 # Aktualny czas w milisekundach
+        self.nav_grid.sync(self.wall_index)
+        self.flow_field.update([p for p in self.game_state.players.values() if not p.dead], self.game_state.frame)
+        enemy_list = list(self.game_state.enemies)
+        steering = EnemySteering(enemy_list)
+        alive_players = None
+        for i, enemy in enumerate(enemy_list):
+            if alive_players is None:
+                # For the first enemy, and for the rest again whenever a player dies
                 alive_players = [p for p in self.game_state.players.values() if not p.dead]
-                target_player = None
-                
-                # Docelowy wektor ruchu i kąt (w stopniach)
-                target_dx = target_dy = 0
-                target_angle_deg = enemy.look_angle
-
                 if alive_players:
-                    # Szukaj najbliższego żywego gracza
-                    target_player = min(alive_players, key=lambda p: ((p.x - enemy.x) ** 2 + (p.y - enemy.y) ** 2) ** 0.5)
-                    # Jeśli to strzelający wróg i jest w zasięgu strzału (np. 300 pikseli), zatrzymaj się i strzel zamiast podchodzić
-                    if enemy._is_shooter and ((enemy.x - target_player.x) ** 2 + (enemy.y - target_player.y) ** 2) ** 0.5 < 300:
-                         target_dx, target_dy = (0, 0) # Zatrzymaj ruch
-                         target_angle_deg = math.degrees(math.atan2(target_player.y - enemy.y, target_player.x - enemy.x)) # Patrz na gracza
-                         # Logika strzelania dla wroga
-                         if now - enemy._last_shot > enemy._fire_rate:
-                              enemy._last_shot = now
-                              # Stwórz pocisk wroga
-                              enemy_bullet = Bullet(enemy.x, enemy.y, target_angle_deg, -1) # -1 player_id for enemy bullet
-                              enemy_bullet.damage = enemy._bullet_damage
-                              enemy_bullet.speed = enemy._bullet_speed
-                              enemy_bullet.color = (255, 0, 0) # Czerwone pociski wroga
-                              self.game_state.bullets.append(enemy_bullet)
-                    else:
-                         # Jeśli nie strzelający wróg, lub poza zasięgiem, biegnij do gracza
-                         angle = math.atan2(target_player.y - enemy.y, target_player.x - enemy.x)
-                         target_dx = math.cos(angle) * enemy.speed
-                         target_dy = math.sin(angle) * enemy.speed
-                         target_angle_deg = math.degrees(angle)
-                else:
-                    # Jeśli nie ma żywych graczy, patroluj
-                    dx, dy = enemy.get_patrol_vector(dt)
-                    target_dx = dx * enemy.speed
-                    target_dy = dy * enemy.speed
-                    target_angle_deg = math.degrees(math.atan2(dy, dx))
-
-                enemy.look_angle = target_angle_deg # Ustaw kąt patrzenia dla synchronizacji
-
+                    plan_start = i
+                    targets, shooting, angles, moves_x, moves_y, clear = steering.plan(alive_players, i, dt, self.wall_cells,
+                                                                                                  self.flow_field, self.line_of_sight)
+            target_player = None
+            move_clear = False
+
+            if alive_players:
+                # Najbliższy żywy gracz
+                k = i - plan_start
+                target_player = alive_players[targets[k]]
+                target_angle_deg = angles[k]
+                move_vector = (moves_x[k], moves_y[k])
+                move_clear = clear[k]
+                # Strzelający wróg w zasięgu strzału, który widzi gracza, stoi w miejscu i strzela zamiast podchodzić
+                if shooting[k] and now - enemy._last_shot > enemy._fire_rate:
+                     enemy._last_shot = now
+                     # Stwórz pocisk wroga
+                     self.game_state.bullets.spawn(enemy.x, enemy.y, target_angle_deg, -1, # -1 player_id for enemy bullet
+                                                   enemy._bullet_speed, enemy._bullet_damage, (255, 0, 0)) # Czerwone pociski wroga
+            else:
+                # Jeśli nie ma żywych graczy, patroluj
+                dx, dy = enemy.get_patrol_vector(dt)
+                target_dx = dx * enemy.speed
+                target_dy = dy * enemy.speed
+                target_angle_deg = math.degrees(math.atan2(dy, dx))
                 # Wektor ruchu na tę klatkę
                 move_vector = (target_dx * dt, target_dy * dt)
 
-                # Podział ruchu na X i Y i sprawdź kolizje oddzielnie
-                original_x, original_y = enemy.x, enemy.y
-                moved_x = False
-                moved_y = False
-
-                # Próba ruchu w X
-                attempt_x = enemy.x + move_vector[0]
-                # Sprawdź kolizję z przyszłą pozycją w X
-                enemy_rect_x = pygame.Rect(attempt_x - enemy.size, enemy.y - enemy.size, enemy.size*2, enemy.size*2)
-                collision_x = False
-                hit_wall_x = None
-                for wall in self.game_state.walls:
-                    if wall.rect.colliderect(enemy_rect_x):
-                        collision_x = True
-                        hit_wall_x = wall # Zapamiętaj uderzoną ścianę
-                        break
-
-                if collision_x:
-                    enemy.x = original_x # Cofnij ruch w X jeśli była kolizja
-                    # Jeśli kolizja w X, zadaj obrażenia ścianie i spróbuj ruchu w Y (wzdłuż ściany)
-                    if hit_wall_x and hasattr(enemy, 'damage') and enemy.damage > 0:
-                         hit_wall_x.health -= enemy.damage # Zadaj obrażenia ścianie
-
-                    if target_player: # Tylko jeśli ścigamy gracza
-                         # Określ kierunek ruchu wzdłuż ściany (prostopadle do target_angle)
-                         wall_follow_angle_rad = math.radians(target_angle_deg) + math.pi / 2 * (1 if random.random() > 0.5 else -1) # Losowo w lewo lub w prawo
-                         # Sprawdź, który kierunek (wall_follow_angle_rad lub wall_follow_angle_rad + pi) jest bliżej celu Y
-                         angle_towards_player_y = math.atan2(target_player.y - enemy.y, target_player.x - enemy.x) # Kąt do gracza
-
-                         angle1_diff = abs((wall_follow_angle_rad - angle_towards_player_y + math.pi) % (2 * math.pi) - math.pi)
-                         angle2_diff = abs((wall_follow_angle_rad + math.pi - angle_towards_player_y + math.pi) % (2 * math.pi) - math.pi)
-
-                         best_wall_follow_angle_rad = wall_follow_angle_rad if angle1_diff < angle2_diff else wall_follow_angle_rad + math.pi
-                         
-                         wall_follow_distance = enemy.speed * dt # Pełny krok wzdłuż ściany
-                         attempt_y_wall_follow = original_y + math.sin(best_wall_follow_angle_rad) * wall_follow_distance
-                         
-                         enemy_rect_y_wall_follow = pygame.Rect(enemy.x - enemy.size, attempt_y_wall_follow - enemy.size, enemy.size*2, enemy.size*2)
-                         collides_with_wall_follow = False
-                         for wall_follow in self.game_state.walls:
-                              if wall_follow.rect.colliderect(enemy_rect_y_wall_follow):
-                                   collides_with_wall_follow = True
-                                   break
-                         if not collides_with_wall_follow:
-                              enemy.y = attempt_y_wall_follow
-                              moved_y = True # Mark as moved in Y due to wall following
-
-                else:
-                     enemy.x = attempt_x # Zastosuj ruch w X jeśli nie było kolizji
-                     moved_x = True
-                
-                # Próba ruchu w Y (tylko jeśli nie było kolizji w X lub jeśli kolizja w X nie zablokowała całkowicie ruchu w Y)
-                # Jeśli ruch w Y nie był spowodowany kolizją w X
-                if not moved_y:
-                    attempt_y = enemy.y + move_vector[1]
-                    # Sprawdź kolizję z przyszłą pozycją w Y
-                    enemy_rect_y = pygame.Rect(enemy.x - enemy.size, attempt_y - enemy.size, enemy.size*2, enemy.size*2)
-                    collision_y = False
-                    hit_wall_y = None
-                    for wall in self.game_state.walls:
-                         if wall.rect.colliderect(enemy_rect_y):
-                             collision_y = True
-                             hit_wall_y = wall # Zapamiętaj uderzoną ścianę
-                             break
-
-                    if collision_y:
-                         enemy.y = original_y # Cofnij ruch w Y jeśli była kolizja
-                         # Jeśli kolizja w Y, zadaj obrażenia ścianie i spróbuj ruchu w X (wzdłuż ściany)
-                         if hit_wall_y and hasattr(enemy, 'damage') and enemy.damage > 0:
-                              hit_wall_y.health -= enemy.damage # Zadaj obrażenia ścianie
-
-                         if target_player: # Tylko jeśli ścigamy gracza
-                              # Określ kierunek ruchu wzdłuż ściany (prostopadle do target_angle)
-                              wall_follow_angle_rad = math.radians(target_angle_deg) + math.pi / 2 * (1 if random.random() > 0.5 else -1) # Losowo w lewo lub w prawo
-                              # Sprawdź, który kierunek (wall_follow_angle_rad lub wall_follow_angle_rad + pi) jest bliżej celu X
-                              angle_towards_player_x = math.atan2(target_player.y - enemy.y, target_player.x - enemy.x) # Kąt do gracza
-                              # Dla X patrzymy na cosinus kąta (ruch w poziomie)
-                              cos1 = math.cos(wall_follow_angle_rad)
-                              cos2 = math.cos(wall_follow_angle_rad + math.pi)
-                              cos_target = math.cos(math.radians(target_angle_deg)) # Użyj kąta ruchu, nie tylko X
-
-                              # Wybierz kierunek wzdłuż ściany, który ma cosinus najbliższy cosinusowi ruchu
-                              best_wall_follow_angle_rad = wall_follow_angle_rad if abs(cos1 - cos_target) < abs(cos2 - cos_target) else wall_follow_angle_rad + math.pi
-
-                              wall_follow_distance = enemy.speed * dt # Pełny krok wzdłuż ściany
-                              attempt_x_wall_follow = original_x + math.cos(best_wall_follow_angle_rad) * wall_follow_distance
-
-                              enemy_rect_x_wall_follow = pygame.Rect(attempt_x_wall_follow - enemy.size, enemy.y - enemy.size, enemy.size*2, enemy.size*2)
-                              collides_with_wall_follow = False
-                              for wall_follow in self.game_state.walls:
-                                  if wall_follow.rect.colliderect(enemy_rect_x_wall_follow):
-                                       collides_with_wall_follow = True
-                                       break
-                              if not collides_with_wall_follow:
-                                   enemy.x = attempt_x_wall_follow
-                                   moved_x = True # Mark as moved in X due to wall following
-                                   break
-                    else:
-                         enemy.y = attempt_y # Zastosuj ruch w Y jeśli nie było kolizji
-                         moved_y = True
-
-                # Kolizja zombie z graczem (zadawanie obrażeń)
-                if target_player and ((enemy.x - target_player.x) ** 2 + (enemy.y - target_player.y) ** 2) ** 0.5 < enemy.size + target_player.size:
-                    target_player.take_damage(enemy.damage)
-                    if target_player.health <= 0 and not target_player.dead:
-                        target_player.kill()
+            enemy.look_angle = target_angle_deg # Ustaw kąt patrzenia dla synchronizacji
 
-            # Usuń zniszczone ściany po przetworzeniu wszystkich wrogów
+            if move_clear:
+                # Z dala od ścian, oba kroki przechodzą bez kolizji
+                enemy.x += move_vector[0]
+                enemy.y += move_vector[1]
+            else:
+                # Zadaj obrażenia ścianom, na które wpadł wróg
+                for hit_wall in self.slide_enemy(enemy, *move_vector):
+                    if hit_wall is not None and enemy.damage > 0:
+                        hit_wall.health -= enemy.damage
+                        self.damaged_walls.add(hit_wall)
+
+            # Kolizja zombie z graczem (zadawanie obrażeń)
+            if target_player and ((enemy.x - target_player.x) ** 2 + (enemy.y - target_player.y) ** 2) ** 0.5 < enemy.size + target_player.size:
+                target_player.take_damage(enemy.damage)
+                if target_player.health <= 0 and not target_player.dead:
+                    target_player.kill()
+                if target_player.dead:
+                    alive_players = None
+
+        # Usuń zniszczone ściany po przetworzeniu wszystkich wrogów
+        # Walls destroyed by bullets are out of the index already, by enemies not yet
+        destroyed = [wall for wall in self.damaged_walls if wall.health <= 0]
+        self.damaged_walls.clear()
+        if destroyed:
+            for wall in destroyed:
+                if wall in self.wall_index:
+                    self.wall_index.remove(wall)
+                if wall.is_player_wall:
+                    self.wall_ids.release(wall.entity_id)
             self.game_state.walls = [wall for wall in self.game_state.walls if wall.health > 0]
 
-            time.sleep(1/60)  # 60 FPS
+    def add_player_wall(self, wall):
+        wall.entity_id = self.wall_ids.allocate()
+        self.game_state.walls.append(wall)
+        self.wall_index.add(wall)
+
+    def slide_enemy(self, enemy, dx, dy):
+        """Moves an enemy one axis at a time and returns the walls it ran into.
+
+        A blocked axis stays put while the other one still moves, so the
+        enemy slides along the wall. When the wall ends within the enemy's
+        size it is nudged round the corner: the flow field's cells are
+        smaller than most enemies, and a path hugging a corner would
+        otherwise hold a big one against it.
+        """
+        size = enemy.size
+        step = math.hypot(dx, dy)
+        hit_walls = []
+        hit_wall = self.wall_index.collide_rect(pygame.Rect(enemy.x + dx - size, enemy.y - size, size*2, size*2))
+        if hit_wall is None:
+            enemy.x += dx
+        else:
+            hit_walls.append(hit_wall)
+            dy = corner_nudge(enemy.y, size, hit_wall.rect.top, hit_wall.rect.bottom, dy, step)
+        hit_wall = self.wall_index.collide_rect(pygame.Rect(enemy.x - size, enemy.y + dy - size, size*2, size*2))
+        if hit_wall is None:
+            enemy.y += dy
+        else:
+            nudge = corner_nudge(enemy.x, size, hit_wall.rect.left, hit_wall.rect.right, 0, step)
+            if not hit_walls and nudge and self.wall_index.collide_rect(
+                    pygame.Rect(enemy.x + nudge - size, enemy.y - size, size*2, size*2)) is None:
+                enemy.x += nudge
+            hit_walls.append(hit_wall)
+        return hit_walls
+
+    def send_snapshots(self):
+        # Records are packed once per tick and each frame is encoded once per
+        # distinct baseline: a delta against the last snapshot the client
+        # acknowledged, or a full snapshot if that baseline is gone
+        self.snapshot_tick += 1
+        snapshot = Snapshot.from_state(self.game_state, self.snapshot_tick)
+        self.snapshot_history.add(snapshot)
+        shared_frames = SnapshotFrames(snapshot, self.snapshot_history)
+        index = build_interest_index(self.game_state, SECTIONS) if self.aoi else None
+        for pid, connection in list(self.clients.items()):
+            frames = shared_frames if index is None else self.interest_frames(pid, snapshot, index)
+            if frames is None:
+                continue
+            baseline_tick = self.snapshot_acks.get(pid, 0)
+            if pid in self.udp_peers:
+                # Unreliable and newest-wins; too big for a datagram goes over TCP
+                datagram = frames.datagram_for(baseline_tick)
+                if datagram is not None:
+                    self.send_datagram(pid, datagram)
+                    continue
+            connection.send_snapshot(frames.frame_for(baseline_tick))
+
+    def interest_frames(self, player_id, snapshot, index):
+        # Each client sees its own subset of the world, so it gets its own
+        # delta history; the record bytes are still shared with the full snapshot
+        player = self.game_state.players.get(player_id)
+        if player is None:
+            return None
+        area = self.interest_areas.setdefault(player_id, InterestArea())
+        visible = area.update(index, player.x, player.y)
+        history = self.client_histories.setdefault(player_id, SnapshotHistory())
+        client_snapshot = snapshot.subset(visible, INTEREST_SECTIONS)
+        history.add(client_snapshot)
+        return SnapshotFrames(client_snapshot, history)
+
+    def broadcast(self):
+        try:
+            self.send_snapshots()
+        except Exception as e:
+            # Clients keep their connections, so keep sending them snapshots
+            print(f"Error sending snapshots: {e!r}")
+
+    async def update_game_state_async(self):
+        # Ticks run on the event loop itself, so no locking around game_state is needed
+        while self.running:
+            self.timestep.run(self.tick)
+            self.report_stats()
+            await asyncio.sleep(self.timestep.delay())
 
-    def broadcast_game_state(self):
+    async def broadcast_game_state_async(self):
         while self.running:
-            for client in self.clients.values():
-                try:
-                    NetworkProtocol.send_message(client, {
-                        'type': 'game_state',
-                        'data': self.game_state.to_dict()
-                    })
-                except:
-                    pass
-            time.sleep(1/30)  # 30 FPS for network updates
+            self.broadcast()
+            await asyncio.sleep(1/self.send_rate)  # 30 FPS for network updates by default
+
+    async def serve_async(self):
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server)
+        if self.udp_socket is not None:
+            await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: DatagramServerProtocol(self), sock=self.udp_socket)
+        # Together, so an exception in a tick stops the server instead of freezing the game
+        async with server:
+            try:
+                await asyncio.gather(server.serve_forever(), self.update_game_state_async(),
+                                     self.broadcast_game_state_async())
+            finally:
+                self.running = False
 
     def run(self):
-        # Start game state update thread
+        # Start game state update thread, it sends the snapshots as well
         update_thread = threading.Thread(target=self.update_game_state)
         update_thread.start()
 
-        # Start broadcast thread
-        broadcast_thread = threading.Thread(target=self.broadcast_game_state)
-        broadcast_thread.start()
+        if self.udp_socket is not None:
+            threading.Thread(target=self.receive_datagrams, daemon=True).start()
 
         try:
             while self.running:
@@ -565,6 +802,107 @@ class GameServer:
             self.running = False
             self.server.close()
 
+    def run_async(self):
+        # One event loop serves every client, no thread per connection
+        try:
+            asyncio.run(self.serve_async())
+        except KeyboardInterrupt:
+            self.running = False
+            self.server.close()
+
+class OfflineClient:
+    """Stands in for a connection when the simulation runs without clients."""
+
+    def send(self, message):
+        pass
+
+def wall_benchmark(counts=(0, 500, 2000, 8000), ticks=300):
+    """Server tick time as player walls pile up, three players shooting all the time."""
+    for count in counts:
+        random.seed(5)
+        server = GameServer(port=0)
+        for x, y in ((60, 60), (740, 60), (60, 540)):
+            pid = server.add_player(OfflineClient())
+            server.game_state.players[pid].x, server.game_state.players[pid].y = x, y
+        for _ in range(count):
+            server.add_player_wall(Wall(random.randint(0, 4000), random.randint(0, 4000), 40, 40, is_player_wall=True))
+        start = time.perf_counter()
+        for i in range(ticks):
+            for pid, player in server.game_state.players.items():
+                server.handle_message(pid, {'type': 'player_input', 'data': {
+                    'seq': i + 1, 'dx': 1 if i % 120 < 60 else -1, 'dy': 0, 'angle': (i * 7 + pid * 120) % 360,
+                    'shoot': True, 'mouse_x': 0, 'mouse_y': 0}}, None)
+                player.health = 500
+                player.ammo['Pistol'] = 100
+            server.last_shot_times = dict.fromkeys(server.last_shot_times, 0)
+            server.tick()
+        elapsed = time.perf_counter() - start
+        print(f"{count:5d} walls: {elapsed / ticks * 1000:.3f} ms/tick ({len(server.game_state.walls)} left)")
+        server.server.close()
+
+def bullet_benchmark(counts=(0, 1000, 3000, 6000), ticks=300):
+    """Server tick time with a given number of bullets in flight.
+
+    Bullets and enemies are topped up every tick, so enemies keep dying
+    and dropping loot all through it.
+    """
+    for count in counts:
+        random.seed(5)
+        server = GameServer(port=0)
+        for x, y in ((60, 60), (740, 60), (60, 540)):
+            pid = server.add_player(OfflineClient())
+            server.game_state.players[pid].x, server.game_state.players[pid].y = x, y
+        server.wave_in_progress, server.zombies_to_spawn = True, 0
+        enemies, bullets = server.game_state.enemies, server.game_state.bullets
+        start = time.perf_counter()
+        for i in range(ticks):
+            for _ in range(40 - len(enemies)):
+                enemies.add(Enemy(random.randint(50, 750), random.randint(50, 550), random.randint(1, 4)))
+            for _ in range(count - len(bullets)):
+                bullets.spawn(random.uniform(0, 800), random.uniform(0, 600), random.uniform(0, 360),
+                              random.choice((-1, 0)), 10, 10, (255, 255, 0))
+            for player in server.game_state.players.values():
+                player.health = 500
+            server.tick()
+        elapsed = time.perf_counter() - start
+        print(f"{count:5d} bullets: {elapsed / ticks * 1000:.3f} ms/tick "
+              f"({len(server.game_state.pickups) + len(server.game_state.lootboxes)} drops lying)")
+        server.server.close()
+
 if __name__ == "__main__":
-    server = GameServer()
-    server.run() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Boxhead multiplayer server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="serve all clients from a single asyncio event loop")
+    parser.add_argument('--udp', action='store_true',
+                        help="also offer snapshots and inputs over UDP to clients started with --udp")
+    parser.add_argument('--aoi', action='store_true',
+                        help="only send each client the entities near its viewport")
+    parser.add_argument('--rate', type=int, default=30,
+                        help="snapshots per second; clients interpolate between them")
+    parser.add_argument('--tick-rate', type=int, default=TICK_RATE,
+                        help="simulation ticks per second; bullet speed and contact damage are per tick, tuned for 60")
+    parser.add_argument('--stats', action='store_true',
+                        help=f"print tick time, overruns, the achieved tick rate and client send queues every {STATS_INTERVAL} seconds")
+    parser.add_argument('--bench-walls', action='store_true',
+                        help="measure tick time against the number of walls and exit")
+    parser.add_argument('--bench-bullets', action='store_true',
+                        help="measure tick time against the number of bullets in flight and exit")
+    args = parser.parse_args()
+
+    if args.bench_walls:
+        wall_benchmark()
+        raise SystemExit
+    if args.bench_bullets:
+        bullet_benchmark()
+        raise SystemExit
+
+    if args.use_async:
+        server = GameServer(args.host, args.port, backlog=128, udp=args.udp, aoi=args.aoi, send_rate=args.rate,
+                            tick_rate=args.tick_rate, stats=args.stats)
+        server.run_async()
+    else:
+        server = GameServer(args.host, args.port, udp=args.udp, aoi=args.aoi, send_rate=args.rate,
+                            tick_rate=args.tick_rate, stats=args.stats)
+        server.run()
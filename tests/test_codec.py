@@ -0,0 +1,50 @@
+import random
+import types
+
+from common.codec import ANGLE, HEALTH, POSITION, TIMER, Snapshot, SnapshotDecoder, encode_snapshot
+from common.game_objects import Player, Enemy, Bullet
+
+
+def angle_error(a, b):
+    return abs((a - b + 180) % 360 - 180)
+
+
+def test_quantization_error_within_half_a_step():
+    # Random entities round-tripped through a snapshot: no quantized field
+    # comes back further than half a quantization step from what was packed
+    rng = random.Random(1)
+    step = {'position': 1 / POSITION.scale, 'angle': 1 / ANGLE.scale, 'health': 1 / HEALTH.scale,
+            'timer': 1 / TIMER.scale}
+    worst = dict.fromkeys(step, 0.0)
+
+    for tick in range(1, 2001):
+        player = Player(rng.uniform(-100, 900), rng.uniform(-100, 700), 0)
+        player.angle = rng.uniform(-180, 180)
+        player.health = rng.uniform(-50, 500)
+        player.armor = rng.uniform(0, 400)
+        player.respawn_timer = rng.uniform(0, 5)
+        enemy = Enemy(rng.uniform(0, 800), rng.uniform(0, 600), rng.randint(1, 4))
+        enemy.look_angle = rng.uniform(-180, 180)
+        enemy.health = rng.uniform(-100, 1000)
+        bullet = Bullet(rng.uniform(0, 800), rng.uniform(0, 600), rng.uniform(-180, 180), 0)
+        state = types.SimpleNamespace(
+            players={0: player}, enemies=[enemy], bullets=[bullet], lootboxes=[], mines=[], pickups=[],
+            walls=[], map_layout=None, frame=tick, game_over=False, wave=1, wave_cooldown=0, scores={})
+        data = SnapshotDecoder().decode(encode_snapshot(Snapshot.from_state(state, tick))).to_dict()
+        p = data['players'][0]
+        e = data['enemies'][0]
+        b = data['bullets'][0]
+        for value, sent in ((p['x'], player.x), (p['y'], player.y), (e['x'], enemy.x), (e['y'], enemy.y),
+                            (b['x'], bullet.x), (b['y'], bullet.y)):
+            worst['position'] = max(worst['position'], abs(value - sent))
+        for value, sent in ((p['angle'], player.angle), (e['look_angle'], enemy.look_angle), (b['angle'], bullet.angle)):
+            worst['angle'] = max(worst['angle'], angle_error(value, sent))
+        for value, sent in ((p['health'], player.health), (p['armor'], player.armor), (e['health'], enemy.health)):
+            worst['health'] = max(worst['health'], abs(value - sent))
+        worst['timer'] = max(worst['timer'], abs(p['respawn_timer'] - player.respawn_timer))
+        # The client must see exactly what snap() predicts
+        assert (p['x'], p['angle']) == (POSITION.snap(player.x), ANGLE.snap(player.angle))
+
+    for kind, error in worst.items():
+        assert error <= step[kind] / 2 + 1e-9, f"{kind} error {error} exceeds half a step"
+
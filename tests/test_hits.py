@@ -0,0 +1,78 @@
+import functools
+import hashlib
+import math
+import random
+
+import numpy as np
+import pytest
+
+import common.bullets
+from common.game_objects import Enemy, WEAPON_LIST
+from server import GameServer, OfflineClient
+
+
+def naive_circle_hits(pool, circles):
+    # The scan the broadphase replaced, every bullet against every circle
+    hits = {}
+    for i, bullet in enumerate(pool):
+        inside = [j for j, (x, y, radius) in enumerate(circles)
+                  if ((bullet.x - x) ** 2 + (bullet.y - y) ** 2) ** 0.5 < radius]
+        if inside:
+            hits[i] = inside
+    near = np.zeros(len(pool), dtype=bool)
+    near[list(hits)] = True
+    return near, hits
+
+
+def fight(seed, naive=False, ticks=600):
+    """Digest per tick of a scripted fight, for comparing hit tests.
+
+    Six players fire Weapon 3 and the Shotgun every tick into a crowd of
+    enemies that also shoot back. Scores, enemies, players and live
+    bullets are hashed after every tick.
+    """
+    random.seed(seed)
+    server = GameServer(port=0)
+    if naive:
+        server.game_state.bullets.circle_hits = functools.partial(naive_circle_hits, server.game_state.bullets)
+    for k in range(6):
+        pid = server.add_player(OfflineClient())
+        player = server.game_state.players[pid]
+        player.x, player.y = 150 + 100 * k, 150 + 60 * (k % 3)
+        player.add_weapon(next(w for w in WEAPON_LIST if w.name == ("Weapon 3", "Shotgun")[k % 2]))
+        player.selected_weapon_index = len(player.weapons) - 1
+    for _ in range(40):
+        server.game_state.enemies.add(Enemy(random.randint(50, 750), random.randint(50, 550), random.randint(1, 4)))
+    digests = []
+    for i in range(ticks):
+        for pid, player in server.game_state.players.items():
+            server.handle_message(pid, {'type': 'player_input', 'data': {
+                'seq': i + 1, 'dx': (i // 40 + pid) % 3 - 1, 'dy': (i // 55 + pid) % 3 - 1,
+                'angle': (i * 11 + pid * 60) % 360, 'shoot': True, 'mouse_x': 0, 'mouse_y': 0}}, None)
+            player.ammo[player.current_weapon.name] = 100
+        # Fire rates go by the wall clock, so everyone fires every tick instead
+        server.last_shot_times = dict.fromkeys(server.last_shot_times, 0)
+        for enemy in server.game_state.enemies:
+            enemy._last_shot = -math.inf
+        server.tick()
+        state = server.game_state
+        digests.append(hashlib.md5(repr((
+            sorted(state.scores.items()),
+            sorted((e.entity_id, e.health, e.x, e.y) for e in state.enemies),
+            [(p.health, p.armor, p.dead) for p in state.players.values()],
+            [b.entity_id for b in state.bullets])).encode()).hexdigest())
+    server.server.close()
+    return digests
+
+
+def first_difference(expected, got):
+    return next((i + 1 for i, (a, b) in enumerate(zip(expected, got)) if a != b), None)
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_broadphase_hits_match_naive_scan(seed, monkeypatch):
+    expected = fight(seed, naive=True)
+    assert first_difference(expected, fight(seed)) is None
+    # Every hit test through the cell grid, however few the pairs
+    monkeypatch.setattr(common.bullets, 'DENSE_MAX', 0)
+    assert first_difference(expected, fight(seed)) is None
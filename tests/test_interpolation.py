@@ -0,0 +1,61 @@
+import types
+
+from common.codec import Snapshot, SnapshotDecoder, encode_snapshot
+from common.game_objects import Enemy, Bullet
+from common.interpolation import SnapshotBuffer, TICK_RATE
+from common.network import GameState
+from common.registry import IdAllocator
+
+
+def client_buffer(frames, world):
+    """Client side of a stream of snapshots: one live GameState and its buffer.
+
+    world(frame) gives the server's enemies and bullets at that frame.
+    Snapshots arrive the moment they are taken, so server and local time agree.
+    """
+    decoder = SnapshotDecoder()
+    live = GameState()
+    buffer = SnapshotBuffer(render_delay=0.1)
+    for frame in frames:
+        enemies, bullets = world(frame)
+        state = types.SimpleNamespace(
+            players={}, enemies=enemies, bullets=bullets, lootboxes=[], mines=[], pickups=[],
+            walls=[], map_layout=None, frame=frame, game_over=False, wave=1, wave_cooldown=0, scores={})
+        live.apply_snapshot(decoder.decode(encode_snapshot(Snapshot.from_state(state, frame))))
+        buffer.add(live, frame / TICK_RATE)
+    return live, buffer
+
+
+def render_at(buffer, frame):
+    return buffer.sample(frame / TICK_RATE + buffer.render_delay)
+
+
+def test_entities_appear_and_leave_at_render_time():
+    ids = IdAllocator()
+    walker = Enemy(100, 100)
+    walker.entity_id = ids.allocate()
+    doomed = Enemy(300, 300)
+    doomed.entity_id = ids.allocate()
+    bullet = Bullet(100, 200, 0, 0)
+    bullet.entity_id = ids.allocate()
+
+    def world(frame):
+        walker.x = 100 + frame
+        bullet.age = frame - 36
+        # One enemy dies after frame 32, a bullet is fired on frame 36
+        return [walker] + [doomed] * (frame <= 32), [bullet] * (frame >= 36)
+
+    # The server is at frame 38, the client draws frame 32.1
+    live, buffer = client_buffer(range(30, 39, 2), world)
+    assert [b.entity_id for b in live.bullets] == [bullet.entity_id]
+    drawn = render_at(buffer, 32.1)
+    assert drawn['bullets'] == []
+    assert sorted(e.entity_id for e in drawn['enemies']) == [walker.entity_id, doomed.entity_id]
+    shown = {e.entity_id: e for e in drawn['enemies']}
+    assert abs(shown[walker.entity_id].x - 132.1) < 0.2
+    assert (shown[doomed.entity_id].x, shown[doomed.entity_id].y) == (300, 300)
+
+    drawn = render_at(buffer, 36.5)
+    assert [e.entity_id for e in drawn['enemies']] == [walker.entity_id]
+    assert [b.entity_id for b in drawn['bullets']] == [bullet.entity_id]
+    assert abs(drawn['bullets'][0].x - (100 + 10 * 0.5)) < 0.2